@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Benchmarks for the reader, parser and entity model. Results are written as
+# JSON so they can be stored and compared between changes:
+#
+#   python benchmarks/run.py --output before.json
+#   ... make changes ...
+#   python benchmarks/run.py --compare before.json
+#
+# With --compare, the exit status is non-zero if any result is worse than
+# the stored one by more than the tolerance. The command latency benchmark
+# talks to the simulated device and so needs a POSIX platform.
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from emu_power import Emu, response_entities  # noqa: E402
+from emu_power.history import History  # noqa: E402
+from emu_power.parser import StreamParser  # noqa: E402
+from emu_power.simulator import EmuSimulator  # noqa: E402
+
+# Whether a larger value of each result is better, for comparisons
+HIGHER_IS_BETTER = {
+    'fragments_per_second': True,
+    'entities_per_second': True,
+    'microseconds_per_entity': False,
+    'latency_ms_mean': False,
+    'latency_ms_p50': False,
+    'latency_ms_p99': False,
+    'bytes_per_entity': False,
+    'bytes_per_history_reading': False
+}
+
+
+# Raw XML for one fragment of each entity class, as the device would send it
+def sample_fragments():
+    simulator = EmuSimulator(seed=0)
+    samples = {}
+    for tag in response_entities.Entity.registered_tags():
+        try:
+            samples[tag] = simulator.notification(tag)
+        except ValueError:
+            samples[tag] = simulator._fragment(tag, [('MeterMacId', simulator.meter_mac)])
+    return samples
+
+
+def best_rate(func, count, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return count / min(times)
+
+
+# Fragments per second through the same path the reader thread uses: the
+# stream parser plus entity construction and storage in Emu
+def bench_parse(samples, count, repeat):
+
+    mix = [samples['InstantaneousDemand'], samples['CurrentSummationDelivered'], samples['PriceCluster']]
+    stream = b''.join(mix[i % len(mix)] for i in range(count))
+
+    # Feed in chunks similar to what a serial read returns
+    chunks = [stream[i:i + 512] for i in range(0, len(stream), 512)]
+
+    def parse_only():
+        parser = StreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+
+    def full_path():
+        emu = Emu()
+        for chunk in chunks:
+            emu._receive(chunk)
+
+    return {
+        'parser_only': {'fragments_per_second': best_rate(parse_only, count, repeat)},
+        'parser_and_entities': {'fragments_per_second': best_rate(full_path, count, repeat)}
+    }
+
+
+# Construction cost of each entity class from an already parsed tree
+def bench_entities(samples, count, repeat):
+
+    results = {}
+    for tag, xml in sorted(samples.items()):
+        klass = response_entities.Entity.tag_to_class(tag)
+        tree = ElementTree.fromstring(xml)
+
+        def construct():
+            for _ in range(count):
+                klass(tree)
+
+        rate = best_rate(construct, count, repeat)
+        results[tag] = {'entities_per_second': rate, 'microseconds_per_entity': 1e6 / rate}
+    return results
+
+
+# Round trip time of synchronous commands against the simulated device
+def bench_latency(count):
+
+    simulator = EmuSimulator(seed=0)
+    emu = Emu(synchronous=True, timeout=5)
+    if not emu.start_serial(simulator.start()):
+        raise RuntimeError("Could not open simulated device")
+
+    try:
+        emu.get_instantaneous_demand()
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            if emu.get_instantaneous_demand() is None:
+                raise RuntimeError("Command timed out")
+            samples.append((time.perf_counter() - start) * 1000)
+    finally:
+        emu.stop_serial()
+        simulator.stop()
+
+    samples.sort()
+    return {'get_instantaneous_demand': {
+        'latency_ms_mean': statistics.mean(samples),
+        'latency_ms_p50': samples[len(samples) // 2],
+        'latency_ms_p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    }}
+
+
+# Memory retained per reading, both as entities and in History
+def bench_memory(samples, count):
+
+    tree = ElementTree.fromstring(samples['InstantaneousDemand'])
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entities = [response_entities.InstantaneousDemand(tree) for _ in range(count)]
+    per_entity = (tracemalloc.get_traced_memory()[0] - before) / count
+    del entities
+
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    history = History(count)
+    for i in range(count):
+        history.append(i, 1.5)
+    per_reading = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+    del history
+
+    return {'InstantaneousDemand': {
+        'bytes_per_entity': per_entity,
+        'bytes_per_history_reading': per_reading
+    }}
+
+
+def run(quick):
+
+    scale = 10 if quick else 1
+    samples = sample_fragments()
+
+    results = {
+        'parse': bench_parse(samples, 20000 // scale, 3),
+        'entities': bench_entities(samples, 20000 // scale, 3),
+        'memory': bench_memory(samples, 100000 // scale)
+    }
+    if os.name == 'posix':
+        results['latency'] = bench_latency(200 // scale)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results
+    }
+
+
+# Compare two result sets, returning a list of regressions as strings
+def compare(baseline, current, tolerance):
+
+    regressions = []
+    for group, cases in current['results'].items():
+        for case, metrics in cases.items():
+            old_metrics = baseline.get('results', {}).get(group, {}).get(case, {})
+            for metric, value in metrics.items():
+                old = old_metrics.get(metric)
+                if old is None or old == 0 or metric not in HIGHER_IS_BETTER:
+                    continue
+                change = (value - old) / old
+                if not HIGHER_IS_BETTER[metric]:
+                    change = -change
+                if change < -tolerance:
+                    regressions.append('{}/{}/{}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+                        group, case, metric, old, value, change))
+    return regressions
+
+
+def main():
+
+    arg_parser = argparse.ArgumentParser(description="Run emu_power benchmarks")
+    arg_parser.add_argument('--output', help="write results to this file instead of stdout")
+    arg_parser.add_argument('--compare', help="compare against results stored in this file")
+    arg_parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="fractional slowdown allowed before failing a comparison")
+    arg_parser.add_argument('--quick', action='store_true', help="run fewer iterations")
+    args = arg_parser.parse_args()
+
+    results = run(args.quick)
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(encoded + '\n')
+    else:
+        print(encoded)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
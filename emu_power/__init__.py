@@ -1,25 +1,83 @@
+import math
 import serial
 import threading
 from xml.etree import ElementTree
 import time
-import itertools
-from emu_power import response_entities
-
-
-class Emu:
+from array import array
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from emu_power import metrics, response_entities, vectorized
+from emu_power.cache import ResponseCache
+from emu_power.capture import CaptureWriter, RECEIVED, SENT
+from emu_power.commands import Commands
+from emu_power.history import History, HISTORY_CLASSES
+from emu_power.metrics import Metrics
+from emu_power.parser import StreamParser
+from emu_power.scheduler import CommandScheduler, Pipeline
+from emu_power.subscriptions import Subscription, DROP_OLDEST
+from emu_power.async_emu import AsyncEmu
+from emu_power.manager import EmuManager
+
+# AsyncEmu and EmuManager are imported to be used from the package
+__all__ = ['Emu', 'AsyncEmu', 'EmuManager']
+
+
+class Emu(Commands):
 
     # Construct a new Emu object. Set synchronous to true to to attempt to
     # return results synchronously if possible. Timeout is the time period
-    # in seconds until a request is considered failed. Poll factor indicates
-    # the fraction of a second to check for a response. Set fresh_only to True
-    # to only return fresh responses from get_data. Only useful in asynchronous mode.
-    def __init__(self, debug=False, fresh_only=False, synchronous=False, timeout=10, poll_factor=2):
+    # in seconds until a request is considered failed, and may be fractional.
+    # Poll factor is no longer used, since synchronous commands are woken as
+    # soon as their response is parsed, and is kept for compatibility. Set
+    # fresh_only to True to only return fresh responses from get_data. Only
+    # useful in asynchronous mode. Set history_size to keep that many of the
+    # most recent readings for each numeric response type (see get_history).
+    # Set capture to a file name to record all raw traffic with the device
+    # to that file while the serial port is open (see capture.py). Retries
+    # is the number of times a command is resent after timing out before
+    # giving up. Set cache to True to answer synchronous queries for slow
+    # changing information (device, meter and network info, schedules and
+    # the meter list) from recent responses, or to a dict of time to live
+    # in seconds keyed by tag to choose what is cached and for how long.
+    # Set metrics to True to collect counters and timings for stats().
+    #
+    # Set reconnect to True to reopen the serial port if it fails, waiting
+    # reconnect_delay seconds before the first attempt and doubling on each
+    # failure up to max_reconnect_delay. The port is also reopened if no
+    # data arrives for stall_timeout seconds, which defaults to stall_periods
+    # times the shortest notification period set with set_schedule or
+    # set_fast_poll. Those settings are sent again after reconnecting. While
+    # the port is down, commands raise ValueError.
+    def __init__(self, debug=False, fresh_only=False, synchronous=False, timeout=10, poll_factor=2,
+                 history_size=0, capture=None, retries=0, cache=None, metrics=False,
+                 reconnect=False, reconnect_delay=1, max_reconnect_delay=60, stall_timeout=None,
+                 stall_periods=3):
 
         # Internal communication
         self._channel_open = False
         self._serial_port = None
+        self._port_name = None
         self._thread_handle = None
         self._stop_thread = False
+        self._parser = StreamParser()
+        self.fragments_invalid = 0
+
+        # Connection supervision
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.stall_timeout = stall_timeout
+        self.stall_periods = stall_periods
+        self.reconnects = 0
+        self.last_error = None
+
+        # The last set_schedule and set_fast_poll commands sent, as
+        # (params, time sent) keyed by (command, meter MAC, event), to be
+        # sent again after reconnecting
+        self._session = {}
+
+        self.capture = capture
+        self._capture_writer = None
 
         self.debug = debug
 
@@ -34,13 +92,50 @@ class Emu:
         # in response_entities.py
         self._data = {}
 
-        # TODO: Implement history mechanism
+        # The same, but keyed by (root element, meter MAC), so that
+        # responses from different meters are kept apart
+        self._meter_data = {}
+
+        # Performance metrics, or None if disabled
+        self._metrics = Metrics() if metrics else None
+
+        # Commands waiting on a response
+        self.retries = retries
+        self._scheduler = CommandScheduler(self._write)
+        if self._metrics is not None:
+            self._scheduler.on_response = self._metrics.record_command
+        self._write_lock = threading.Lock()
+
+        # Cache of slow changing responses, or None if disabled
+        self._cache = None
+        if cache:
+            self._cache = ResponseCache(None if cache is True else cache)
+
+        # Subscriptions to entities as they are parsed, keyed by root
+        # element, or None for subscriptions to everything. The lists are
+        # replaced rather than modified so the reader can iterate safely.
+        self._subscriptions = {}
+        self._subscription_lock = threading.Lock()
+
+        # Bounded reading history for numeric response types, keyed by
+        # (root element, meter MAC) and created as each meter is heard from.
+        # Empty if history is disabled.
+        self.history_size = history_size
+        self._history = {}
+        self._history_tags = set()
+        if history_size > 0:
+            self._history_tags = set(klass.tag_name() for klass in HISTORY_CLASSES)
 
     # Get the most recent fresh response that has come in. This
-    # should be used in asynchronous mode.
-    def get_data(self, klass):
+    # should be used in asynchronous mode. Pass the MAC of a meter
+    # to get the most recent response from that meter only.
+    def get_data(self, klass, mac=None):
+
+        if mac is None:
+            res = self._data.get(klass.tag_name())
+        else:
+            res = self._meter_data.get(response_entities.meter_key(klass.tag_name(), mac))
 
-        res = self._data.get(klass.tag_name())
         if not self.fresh_only:
             return res
 
@@ -50,6 +145,106 @@ class Emu:
         res.fresh = False
         return res
 
+    # MACs of every meter responses have come in from
+    def get_meters(self):
+        return sorted(set(mac for _, mac in list(self._meter_data) if mac is not None))
+
+    # Get (timestamp, reading) pairs from the history of the given class
+    # with start <= timestamp <= end, where timestamps are Unix times. Either
+    # bound may be None. History is kept per meter; if mac is None, the
+    # meter of the most recent reading is used.
+    def get_history(self, klass, start=None, end=None, mac=None):
+        history = self._get_history(klass, mac)
+        if history is None:
+            return []
+        return history.range(start, end)
+
+    # Get every (timestamp, reading) pair received for the given class since
+    # the last call, along with the cursor to pass in next time. Start with
+    # a cursor of 0.
+    def get_history_since(self, klass, cursor=0, mac=None):
+        history = self._get_history(klass, mac)
+        if history is None:
+            return [], cursor
+        return history.since(cursor)
+
+    # Get the whole history of the given class as NumPy arrays of timestamps
+    # and readings, oldest first. Requires numpy.
+    def get_history_arrays(self, klass, mac=None):
+        history = self._get_history(klass, mac)
+        if history is None:
+            return vectorized.entries_to_arrays([])
+        return vectorized.history_to_arrays(history)
+
+    def _get_history(self, klass, mac):
+        tag = klass.tag_name()
+        if mac is None:
+            latest = self._data.get(tag)
+            if latest is None:
+                return None
+            mac = latest.meter_mac
+        return self._history.get(response_entities.meter_key(tag, mac))
+
+    # Call callback(entity) for each entity of the given class as soon as it
+    # is parsed, rather than polling get_data. By default the callback runs
+    # on the reader thread and must be quick. Set queue_size to hand entities
+    # to a worker thread through a bounded queue instead, with policy deciding
+    # what happens when it is full (see subscriptions.py). Returns the
+    # subscription, which can be passed to unsubscribe.
+    def subscribe(self, klass, callback, queue_size=0, policy=DROP_OLDEST):
+        return self._add_subscription(klass.tag_name(), callback, queue_size, policy)
+
+    # As subscribe, but for every entity received regardless of class
+    def subscribe_all(self, callback, queue_size=0, policy=DROP_OLDEST):
+        return self._add_subscription(None, callback, queue_size, policy)
+
+    def unsubscribe(self, subscription):
+        with self._subscription_lock:
+            subscriptions = list(self._subscriptions.get(subscription.tag, []))
+            subscriptions.remove(subscription)
+            self._subscriptions[subscription.tag] = subscriptions
+        subscription.close()
+
+    def _add_subscription(self, tag, callback, queue_size, policy):
+        subscription = Subscription(callback, tag, queue_size, policy, self.debug)
+        with self._subscription_lock:
+            self._subscriptions[tag] = self._subscriptions.get(tag, []) + [subscription]
+        return subscription
+
+    # Counters, queue depths and, if metrics are enabled, timings for this
+    # object as a dict. See also prometheus_metrics().
+    def stats(self):
+
+        stats = {} if self._metrics is None else self._metrics.snapshot()
+        stats.update(self.get_parse_stats())
+        stats['command_timeouts'] = self._scheduler.timeouts
+        stats['command_retries'] = self._scheduler.retries
+        stats['commands_in_flight'] = self._scheduler.in_flight()
+        stats['connected'] = int(self._serial_port is not None)
+        stats['reconnects'] = self.reconnects
+
+        subscriptions = [s for subs in list(self._subscriptions.values()) for s in subs]
+        stats['subscription_queue_depth'] = sum(s.pending() for s in subscriptions)
+        stats['subscription_dropped'] = sum(s.dropped for s in subscriptions)
+
+        if self._cache is not None:
+            stats['cache_hits'] = self._cache.hits
+            stats['cache_misses'] = self._cache.misses
+
+        return stats
+
+    # The output of stats() in the Prometheus text exposition format
+    def prometheus_metrics(self):
+        return metrics.to_prometheus(self.stats())
+
+    # Counters for data thrown away while recovering from corrupt XML
+    def get_parse_stats(self):
+        return {
+            'bytes_discarded': self._parser.bytes_discarded,
+            'fragments_discarded': self._parser.fragments_discarded,
+            'fragments_invalid': self.fragments_invalid
+        }
+
     # Open communication channel
     def start_serial(self, port_name):
 
@@ -57,13 +252,15 @@ class Emu:
             return True
 
         try:
-            self._serial_port = serial.Serial(port_name, 115200, timeout=1)
+            port = serial.Serial(port_name, 115200, timeout=1)
         except serial.serialutil.SerialException:
             return False
 
+        self._port_name = port_name
+        self._attach(port)
+        self._stop_thread = False
         self._thread_handle = threading.Thread(target=self._communication_thread)
         self._thread_handle.start()
-        self._channel_open = True
         return True
 
     # Close the communication channel
@@ -73,260 +270,440 @@ class Emu:
             return True
 
         self._stop_thread = True
-        self._thread_handle.join()
-        self._thread_handle = None
-        self._serial_port.close()
-        self._serial_port = None
+        if self._thread_handle is not None:
+            self._thread_handle.join()
+            self._thread_handle = None
+
+        self._close_port()
+        self._detach()
+        self._session = {}
         return True
 
-    # Main communication thread - handles all asynchronous messaging
+    # Use a serial port that is opened and read by someone else, such as
+    # EmuManager, instead of our own thread. Data read from the port must
+    # be passed to _receive. Schedule settings made before the port was
+    # lost are sent again.
+    def _attach(self, port):
+        with self._write_lock:
+            self._serial_port = port
+        self._parser.reset()
+        self._open_capture()
+        self._channel_open = True
+        self._replay_session()
+
+    # Stop using a port previously given to _attach
+    def _detach(self):
+        self._channel_open = False
+        self._serial_port = None
+        self._close_capture()
+        self._scheduler.cancel_all()
+
+    def _open_capture(self):
+        if self.capture is not None and self._capture_writer is None:
+            self._capture_writer = CaptureWriter(self.capture)
+
+    def _close_capture(self):
+        if self._capture_writer is not None:
+            self._capture_writer.close()
+            self._capture_writer = None
+
+    # Write to the device, recording the data if capturing. Writes from
+    # different threads are serialized so commands are never interleaved.
+    def _write(self, data):
+        with self._write_lock:
+            if self._serial_port is None:
+                raise ValueError("Serial port is not connected")
+            if self._capture_writer is not None:
+                self._capture_writer.record(SENT, data)
+            self._serial_port.write(data)
+
+    # Close our serial port, if it is open. Commands waiting on a response
+    # are given up on.
+    def _close_port(self):
+
+        with self._write_lock:
+            port = self._serial_port
+            self._serial_port = None
+
+        if port is not None:
+            try:
+                port.close()
+            except (serial.serialutil.SerialException, OSError):
+                pass
+        self._scheduler.cancel_all()
+
+    # Main communication thread - handles all asynchronous messaging. If
+    # the port fails, it is reopened with backoff when reconnect is set,
+    # and otherwise the channel is closed. The channel is also closed if
+    # the thread fails unexpectedly, rather than leaving it open with
+    # nothing reading it.
     def _communication_thread(self):
-        while True:
+        try:
+            self._read_loop()
+        except Exception as e:
+            if self.debug:
+                print("Reader thread failed: " + repr(e))
+            self.last_error = repr(e)
+            self._close_port()
+            self._detach()
+            self._stop_thread = False
 
-            if self._stop_thread:
-                self._stop_thread = False
-                return
+    def _read_loop(self):
 
-            # Update read data, ignoring timeouts
-            bin_lines = self._serial_port.readlines()
+        failures = 0
+        next_attempt = 0
+        last_data = time.time()
 
-            if len(bin_lines) > 0:
+        while not self._stop_thread:
 
-                # A response can have multiple fragments, so we wrap them in a pseudo root for parsing
+            port = self._serial_port
+            if port is None:
+                if time.time() < next_attempt:
+                    time.sleep(0.1)
+                    continue
                 try:
-                    wrapped = itertools.chain('<Root>', bin_lines, '</Root>')
-                    root = ElementTree.fromstringlist(wrapped)
-                except ElementTree.ParseError:
-                    if self.debug:
-                        print("Malformed XML " + b''.join(bin_lines).decode('ASCII'))
+                    port = serial.Serial(self._port_name, 115200, timeout=1)
+                except (serial.serialutil.SerialException, OSError) as e:
+                    self.last_error = str(e)
+                    failures += 1
+                    next_attempt = time.time() + self._reconnect_backoff(failures)
                     continue
 
-                for tree in root:
+                if self.debug:
+                    print("Reconnected to " + self._port_name)
+                self.reconnects += 1
+                failures = 0
+                last_data = time.time()
+                self._attach(port)
+                continue
+
+            # Block until at least one byte arrives (or the read times out),
+            # then take whatever else is already buffered. Fragments are
+            # handled as soon as their closing tag is received.
+            # Anything going wrong while handling the data is treated as a
+            # failure of the port, so it is reopened if reconnect is set.
+            try:
+                data = port.read(port.in_waiting or 1)
+                if len(data) > 0:
+                    last_data = time.time()
+                    self._receive(data)
+                    continue
+            except (serial.serialutil.SerialException, OSError) as e:
+                error = str(e)
+            except Exception as e:
+                error = "Failed handling data: " + repr(e)
+            else:
+                stall_timeout = self._stall_timeout()
+                if stall_timeout is None or time.time() - last_data < stall_timeout:
+                    continue
+                error = "No data for {:.0f} seconds".format(time.time() - last_data)
 
-                    if self.debug:
-                        ElementTree.dump(tree)
+            if self.debug:
+                print("Serial port failed: " + error)
+            self.last_error = error
+            self._close_port()
 
-                    response_type = tree.tag
-                    klass = response_entities.Entity.tag_to_class(response_type)
-                    if klass is None:
-                        if self.debug:
-                            print("Unsupported tag " + response_type)
-                        continue
-                    else:
-                        self._data[response_type] = klass(tree)
+            if not self.reconnect:
+                self._detach()
+                return
 
-    # Issue a command to the device. Pass the command name as the first
-    # argument, and any additional params as a dict. Will return immediately
-    # unless the synchronous attribute on the library is true, in which case
-    # it will return data when available, or None if the timeout has elapsed.
-    def issue_command(self, command, params=None, return_class=None):
+            failures += 1
+            next_attempt = time.time() + self._reconnect_backoff(failures)
 
-        if not self._channel_open:
-            raise ValueError("Serial port is not open")
+        self._stop_thread = False
 
-        root = ElementTree.Element('Command')
-        name_field = ElementTree.SubElement(root, 'Name')
-        name_field.text = command
+    def _reconnect_backoff(self, failures):
+        return min(self.reconnect_delay * (2 ** (failures - 1)), self.max_reconnect_delay)
 
-        if params is not None:
-            for k, v in params.items():
-                if v is not None:
-                    field = ElementTree.SubElement(root, k)
-                    field.text = v
+    # Seconds without data before the port is considered stalled, or None
+    # if stall detection is off
+    def _stall_timeout(self):
 
-        bin_string = ElementTree.tostring(root)
+        if not self.reconnect:
+            return None
+        if self.stall_timeout is not None:
+            return self.stall_timeout
+
+        now = time.time()
+        periods = []
+        for (command, _, _), (params, sent) in list(self._session.items()):
+            frequency = int(params.get('Frequency') or '0x00', 16)
+            if frequency <= 0:
+                continue
+            if command == 'set_schedule' and params.get('Enabled') != 'N':
+                periods.append(frequency)
+            elif command == 'set_fast_poll' and now < sent + int(params.get('Duration') or '0x00', 16) * 60:
+                periods.append(frequency)
+
+        if not periods:
+            return None
+        return self.stall_periods * min(periods)
 
-        if self.debug:
-            ElementTree.dump(root)
+    # Keep track of the schedule settings sent, for _replay_session
+    def _remember(self, command, params):
 
-        if (not self.synchronous) or return_class is None:
-            if self.debug:
-                print("Object is in asynchronous mode or command does not have return type - not waiting for response")
-            self._serial_port.write(bin_string)
-            return True
+        if command not in ('set_schedule', 'set_fast_poll', 'set_schedule_default'):
+            return
 
-        # Do our best to return results synchronously
-        tag = return_class.tag_name()
+        params = dict(params or {})
+        mac = params.get('MeterMacId')
+        mac = None if mac is None else mac.lower()
+        event = params.get('Event')
 
-        # Invalidate current response
-        cur = self._data.get(tag)
-        if cur is not None:
-            cur.fresh = False
+        if command == 'set_schedule_default':
+            for key in list(self._session):
+                if key[0] == 'set_schedule' and key[1] == mac and (event is None or key[2] == event):
+                    del self._session[key]
+            return
 
-        self._serial_port.write(bin_string)
+        self._session[(command, mac, event)] = (params, time.time())
 
-        step = 1.0 / self.poll_factor
-        for i in range(0, self.timeout * self.poll_factor):
-            d = self._data.get(tag)
-            if d is not None and d.fresh:
-                return d
-            else:
-                time.sleep(step)
+    # Send the schedule settings remembered by _remember again, after the
+    # port has been reopened. Fast poll is only resumed for the time it had
+    # left to run.
+    def _replay_session(self):
+
+        for (command, _, _), (params, sent) in list(self._session.items()):
+            if command == 'set_fast_poll' and params.get('Duration') is not None:
+                remaining = int(params['Duration'], 16) * 60 - (time.time() - sent)
+                if remaining <= 0:
+                    continue
+                params = dict(params, Duration=self._format_hex(int(math.ceil(remaining / 60.0)), digits=4))
 
-        return None
+            if self.debug:
+                print("Restoring " + command)
+            try:
+                self._write(self._build_command(command, params))
+            except (serial.serialutil.SerialException, OSError, ValueError):
+                return
 
-    # Convert boolean to Y/N for commands
-    def _format_yn(self, value):
-        if value is None:
+    # Feed raw bytes from the device through the parser and handle every
+    # completed fragment. Returns the entities created.
+    def _receive(self, data):
+
+        if self._capture_writer is not None:
+            self._capture_writer.record(RECEIVED, data)
+
+        started = time.perf_counter()
+        discarded = self._parser.bytes_discarded
+        fragments = self._parser.feed(data)
+        if self.debug and self._parser.bytes_discarded > discarded:
+            print("Malformed XML " + data.decode('ASCII', errors='replace'))
+
+        entities = []
+        metrics = self._metrics
+        if metrics is None:
+            for tree in fragments:
+                entity = self._handle_fragment(tree)
+                if entity is not None:
+                    entities.append(entity)
+            return entities
+
+        # Same again, timing each fragment. Time spent in the stream parser
+        # is shared evenly between the fragments it produced.
+        metrics.bytes_read += len(data)
+        share = (time.perf_counter() - started) / len(fragments) if fragments else 0
+        for tree in fragments:
+            start = time.perf_counter()
+            entity = self._parse_fragment(tree)
+            if entity is not None:
+                metrics.record_fragment(tree.tag, share + time.perf_counter() - start)
+                self._dispatch(entity)
+                entities.append(entity)
+        return entities
+
+    # Convert a parsed fragment into its response entity and store it.
+    # Returns None if the tag is not supported.
+    def _handle_fragment(self, tree):
+        entity = self._parse_fragment(tree)
+        if entity is not None:
+            self._dispatch(entity)
+        return entity
+
+    # Convert a parsed fragment into its response entity, or None if the
+    # tag is not supported
+    def _parse_fragment(self, tree):
+
+        if self.debug:
+            ElementTree.dump(tree)
+
+        klass = response_entities.Entity.tag_to_class(tree.tag)
+        if klass is None:
+            if self.debug:
+                print("Unsupported tag " + tree.tag)
+            if self._metrics is not None:
+                self._metrics.record_unsupported(tree.tag)
             return None
-        if value:
-            return 'Y'
-        else:
-            return 'N'
-
-    # Convert an integer into a hex string
-    def _format_hex(self, num, digits=8):
-        return "0x{:0{digits}x}".format(num, digits=digits)
-
-    # Check if an event is a valid value
-    def _check_valid_event(self, event, allow_none=True):
-        enum = ['time', 'summation', 'billing_period', 'block_period',
-                'message', 'price', 'scheduled_prices', 'demand']
-        if allow_none:
-            enum.append(None)
-        if event not in enum:
-            raise ValueError('Invalid event specified')
-
-    # The following are convenience methods for sending commands. Commands
-    # can also be sent manually using the generic issue_command method.
-
-    #################################
-    #         Raven Commands        #
-    #################################
-
-    def restart(self):
-        return self.issue_command('restart')
-
-    # Dangerous! Will decommission device!
-    def factory_reset(self):
-        return self.issue_command('factory_reset')
-
-    def get_connection_status(self):
-        return self.issue_command('get_connection_status', return_class=response_entities.ConnectionStatus)
-
-    def get_device_info(self):
-        return self.issue_command('get_device_info', return_class=response_entities.DeviceInfo)
-
-    def get_schedule(self, mac=None, event=None):
-        self._check_valid_event(event)
-        opts = {'MeterMacId': mac, 'Event': event}
-        return self.issue_command('get_schedule', opts, return_class=response_entities.ScheduleInfo)
-
-    def set_schedule(self, mac=None, event=None, frequency=10, enabled=True):
-        self._check_valid_event(event, allow_none=False)
-        opts = {
-            'MeterMacId': mac,
-            'Event': event,
-            'Frequency': self._format_hex(frequency),
-            'Enabled': self._format_yn(enabled)
-        }
-        return self.issue_command('set_schedule', opts)
 
-    def set_schedule_default(self, mac=None, event=None):
-        self._check_valid_event(event)
-        opts = {'MeterMacId': mac, 'Event': event}
-        return self.issue_command('set_schedule_default', opts)
+        # Well formed XML can still hold values that do not convert, such
+        # as a corrupt hex number. Treat those like malformed fragments.
+        try:
+            return klass(tree)
+        except (ValueError, TypeError) as e:
+            if self.debug:
+                print("Invalid " + tree.tag + ": " + str(e))
+            self.fragments_invalid += 1
+            return None
 
-    def get_meter_list(self):
-        return self.issue_command('get_meter_list', return_class=response_entities.MeterList)
+    # Store a new entity, and pass it on to everything interested in it
+    def _dispatch(self, entity):
 
-    ##########################
-    #     Meter Commands     #
-    ##########################
+        response_type = entity.tag_name()
+        key = response_entities.meter_key(response_type, getattr(entity, 'meter_mac', None))
+        self._data[response_type] = entity
+        self._meter_data[key] = entity
 
-    def get_meter_info(self, mac=None):
-        opts = {'MeterMacId': mac}
-        return self.issue_command('get_meter_info', opts, return_class=response_entities.MeterInfo)
+        if response_type in self._history_tags:
+            history = self._history.get(key)
+            if history is None:
+                history = self._history[key] = History(self.history_size)
+            history.append_entity(entity)
 
-    def get_network_info(self):
-        return self.issue_command('get_network_info', return_class=response_entities.NetworkInfo)
+        # Hand the response to the command waiting on it, if any
+        self._scheduler.resolve(entity)
 
-    def set_meter_info(self, mac=None, nickname=None, account=None, auth=None, host=None, enabled=None):
+        if self._cache is not None:
+            self._cache.update(entity)
 
-        opts = {
-            'MeterMacId': mac,
-            'NickName': nickname,
-            'Account': account,
-            'Auth': auth,
-            'Host': host,
-            'Enabled': self._format_yn(enabled)
-        }
-        return self.issue_command('set_meter_info', opts)
+        for tag in (response_type, None):
+            for subscription in self._subscriptions.get(tag, ()):
+                subscription.deliver(entity)
 
-    ############################
-    #       Time Commands      #
-    ############################
+    # Issue a command to the device. Pass the command name as the first
+    # argument, and any additional params as a dict. Will return immediately
+    # unless the synchronous attribute on the library is true, in which case
+    # it will return data when available, or None if the timeout has elapsed.
+    def issue_command(self, command, params=None, return_class=None):
 
-    def get_time(self, mac=None, refresh=True):
-        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
-        return self.issue_command('get_time', opts, return_class=response_entities.TimeCluster)
+        if not self._channel_open:
+            raise ValueError("Serial port is not open")
 
-    def get_message(self, mac=None, refresh=True):
-        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
-        return self.issue_command('get_message', opts, return_class=response_entities.MessageCluster)
+        bin_string = self._build_command(command, params)
 
-    def confirm_message(self, mac=None, message_id=None):
+        if self.debug:
+            print(bin_string.decode('ASCII'))
 
-        if message_id is None:
-            raise ValueError('Message id is required')
+        if self._cache is not None:
+            self._cache.invalidate_for(command)
+        self._remember(command, params)
 
-        opts = {'MeterMacId': mac, 'Id': self._format_hex(message_id)}
-        return self.issue_command('confirm_message', opts)
+        if (not self.synchronous) or return_class is None:
+            if self.debug:
+                print("Object is in asynchronous mode or command does not have return type - not waiting for response")
+            self._write(bin_string)
+            return True
 
-    #########################
-    #     Price Commands    #
-    #########################
+        # Do our best to return results synchronously. Invalidate the
+        # current response, then wait for the scheduler to resolve this
+        # command, which it does with None on timeout. The wait is bounded
+        # as well (with a few seconds to spare), in case the command is
+        # never resolved.
+        cur = self._data.get(return_class.tag_name())
+        if cur is not None:
+            cur.fresh = False
 
-    def get_current_price(self, mac=None, refresh=True):
-        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
-        return self.issue_command('get_current_price', opts, return_class=response_entities.PriceCluster)
+        future = self._submit(command, bin_string, params, return_class, self.timeout, self.retries)
+        try:
+            return future.result(self.timeout * (self.retries + 1) + 5)
+        except TimeoutError:
+            return None
 
-    # Price is in cents, w/ decimals (e.g. "24.373")
-    def set_current_price(self, mac=None, price="0.0"):
+    # Issue a command and return a Future for its response, whether or not
+    # the library is in synchronous mode. The Future resolves to the response
+    # entity, or None if there was no response within the timeout after the
+    # given number of retries (both default to the attributes of the same
+    # name). Commands without a return class resolve to True once sent.
+    # Several commands may be in flight at once; see also pipeline().
+    def submit_command(self, command, params=None, return_class=None, timeout=None, retries=None):
 
-        parts = price.split(".", 1)
-        if len(parts) == 1:
-            trailing = 2
-            price = int(parts[0])
-        else:
-            trailing = len(parts[1]) + 2
-            price = int(parts[0] + parts[1])
+        if not self._channel_open:
+            raise ValueError("Serial port is not open")
 
-        opts = {
-            'MeterMacId': mac,
-            'Price': self._format_hex(price),
-            'TrailingDigits': self._format_hex(trailing, digits=2)
-        }
-        return self.issue_command('set_current_price', opts)
+        bin_string = self._build_command(command, params)
 
-    ###############################
-    #   Simple Metering Commands  #
-    ###############################
+        if self.debug:
+            print(bin_string.decode('ASCII'))
+
+        if self._cache is not None:
+            self._cache.invalidate_for(command)
+        self._remember(command, params)
+
+        if return_class is None:
+            self._write(bin_string)
+            future = Future()
+            future.set_result(True)
+            return future
+
+        return self._submit(
+            command, bin_string, params, return_class,
+            self.timeout if timeout is None else timeout,
+            self.retries if retries is None else retries
+        )
+
+    def _submit(self, command, bin_string, params, return_class, timeout, retries):
+        meter_mac = None if params is None else params.get('MeterMacId')
+        return self._scheduler.submit(bin_string, return_class, meter_mac, timeout, retries, command)
+
+    # Answer queries for slow changing information from the cache if enabled
+    def _query(self, command, params=None, return_class=None):
+        if self._cache is None or not self.synchronous:
+            return self.issue_command(command, params, return_class)
+        return self._cache.get_or_fetch(
+            return_class, params, lambda: self.issue_command(command, params, return_class))
+
+    # Empty the response cache, so the next queries go to the device
+    def clear_cache(self):
+        if self._cache is not None:
+            self._cache.invalidate()
+
+    # Fetch the interval data recorded by the meter back to start, a Unix
+    # time, from end or the most recent interval if it is None. Requests for
+    # 12 intervals at a time are pipelined, with up to window of them in
+    # flight, walking backwards until start is reached or the meter has no
+    # older data. Returns arrays of interval end times and raw values, oldest
+    # first (see ProfileData).
+    def get_profile_history(self, start, end=None, mac=None, channel='Delivered', window=4):
+
+        pipeline = self.pipeline()
+        intervals = {}
+
+        first = pipeline.get_profile_data(mac, 12, end, channel).result()
+        finished = not self._merge_profile(intervals, first)
+        if not finished:
+            step = first.interval_seconds
+            request_end = first.interval_times()[0] - step
+
+        pending = deque()
+        while True:
+            while not finished and len(pending) < window and request_end > start:
+                pending.append(pipeline.get_profile_data(mac, 12, request_end, channel))
+                request_end -= 12 * step
+            if not pending:
+                break
 
-    def get_instantaneous_demand(self, mac=None, refresh=True):
-        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
-        return self.issue_command('get_instantaneous_demand', opts, return_class=response_entities.InstantaneousDemand)
+            # Outstanding requests are still collected once finished, so
+            # their responses are not left to be matched to later commands
+            if not self._merge_profile(intervals, pending.popleft().result()):
+                finished = True
 
-    def get_current_summation_delivered(self, mac=None, refresh=True):
-        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
-        return self.issue_command('get_current_summation_delivered', opts, return_class=response_entities.CurrentSummationDelivered)
+        times = sorted(t for t in intervals if t >= start)
+        return array('d', times), array('d', (intervals[t] for t in times))
 
-    def get_current_period_usage(self, mac=None):
-        opts = {'MeterMacId': mac}
-        return self.issue_command('get_current_period_usage', opts, return_class=response_entities.CurrentPeriodUsage)
+    # Add the intervals in a ProfileData response to a dict keyed by end
+    # time. Returns whether there may be older data to fetch.
+    def _merge_profile(self, intervals, profile):
 
-    def get_last_period_usage(self, mac=None):
-        opts = {'MeterMacId': mac}
-        return self.issue_command('get_last_period_usage', opts, return_class=response_entities.LastPeriodUsage)
+        if profile is None or response_entities.as_hex(profile.status) != 0:
+            return False
+        times = profile.interval_times()
+        if not times:
+            return False
 
-    def close_current_period(self, mac=None):
-        opts = {'MeterMacId': mac}
-        return self.issue_command('close_current_period', opts)
+        intervals.update(zip(times, profile.interval_data))
+        return len(times) == 12
 
-    def set_fast_poll(self, mac=None, frequency=4, duration=20):
-        opts = {
-            'MeterMacId': mac,
-            'Frequency': self._format_hex(frequency, digits=4),
-            'Duration': self._format_hex(duration, digits=4)
-        }
-        return self.issue_command('set_fast_poll', opts)
+    # Get a Pipeline, whose command methods send immediately and return
+    # Futures instead of waiting, so that several requests share one round
+    # trip. Timeout and retries default to the attributes of this object.
+    def pipeline(self, timeout=None, retries=None):
+        return Pipeline(self, timeout, retries)
@@ -0,0 +1,210 @@
+import asyncio
+import serial
+from xml.etree import ElementTree
+from emu_power import response_entities
+from emu_power.commands import Commands
+from emu_power.parser import StreamParser
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+# asyncio client for the EMU-2. This runs entirely on the event loop using an
+# asyncio serial transport, so no thread is needed per device. All of the
+# command methods are shared with Emu, but here they return awaitables which
+# resolve to the response entity as soon as it has been parsed, or None if
+# the timeout elapses. Requires the pyserial-asyncio package.
+class AsyncEmu(Commands):
+
+    def __init__(self, debug=False, timeout=10):
+
+        self._transport = None
+        self._parser = StreamParser()
+
+        self.debug = debug
+        self.timeout = timeout
+
+        # Most recent entity for each root tag, and for each root tag and
+        # meter, as in Emu
+        self._data = {}
+        self._meter_data = {}
+
+        # Futures waiting on a response, and queues feeding notification
+        # streams, both keyed by root tag. Streams for all tags are keyed
+        # by None.
+        self._waiters = {}
+        self._streams = {}
+
+        # Fragments dropped because a value could not be converted
+        self.fragments_invalid = 0
+
+    # Get the most recent response that has come in for the given class,
+    # from the given meter if mac is not None
+    def get_data(self, klass, mac=None):
+        if mac is None:
+            return self._data.get(klass.tag_name())
+        return self._meter_data.get(response_entities.meter_key(klass.tag_name(), mac))
+
+    # Counters for data thrown away while recovering from corrupt XML
+    def get_parse_stats(self):
+        return {
+            'bytes_discarded': self._parser.bytes_discarded,
+            'fragments_discarded': self._parser.fragments_discarded,
+            'fragments_invalid': self.fragments_invalid
+        }
+
+    # Open communication channel on the running event loop
+    async def start_serial(self, port_name):
+
+        if self._transport is not None:
+            return True
+
+        if serial_asyncio is None:
+            raise ImportError("AsyncEmu requires the pyserial-asyncio package")
+
+        loop = asyncio.get_event_loop()
+        self._parser.reset()
+
+        try:
+            self._transport, _ = await serial_asyncio.create_serial_connection(
+                loop, lambda: _EmuProtocol(self), port_name, baudrate=115200)
+        except serial.serialutil.SerialException:
+            return False
+
+        return True
+
+    # Close the communication channel
+    async def stop_serial(self):
+
+        if self._transport is None:
+            return True
+
+        self._transport.close()
+        self._transport = None
+        return True
+
+    # Issue a command to the device. If a return class is given, this waits
+    # for the matching response and returns it, or None on timeout.
+    # Otherwise it returns True as soon as the command has been written.
+    async def issue_command(self, command, params=None, return_class=None):
+
+        if self._transport is None:
+            raise ValueError("Serial port is not open")
+
+        bin_string = self._build_command(command, params)
+
+        if self.debug:
+            print(bin_string.decode('ASCII'))
+
+        if return_class is None:
+            self._transport.write(bin_string)
+            return True
+
+        # Register before writing so a fast response cannot be missed
+        tag = return_class.tag_name()
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(tag, []).append(future)
+
+        try:
+            self._transport.write(bin_string)
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(tag)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+
+    # Asynchronously iterate over notifications of the given class as they
+    # arrive, or over all notifications if no class is given. Maxsize bounds
+    # the number of readings buffered for a slow consumer; once full, new
+    # readings are dropped until the consumer catches up. Iteration ends
+    # when the port is closed or goes away.
+    async def stream(self, klass=None, maxsize=0):
+
+        tag = None if klass is None else klass.tag_name()
+        queue = asyncio.Queue(maxsize)
+        self._streams.setdefault(tag, []).append(queue)
+
+        try:
+            while True:
+                entity = await queue.get()
+                if entity is None:
+                    return
+                yield entity
+        finally:
+            self._streams[tag].remove(queue)
+
+    # Called by the protocol with raw bytes from the serial port
+    def _data_received(self, data):
+        for tree in self._parser.feed(data):
+            self._handle_fragment(tree)
+
+    # Called by the protocol when the port goes away. Anybody still waiting
+    # on a response gets None rather than waiting out the full timeout, and
+    # notification streams are ended with None, making room for it by
+    # dropping a reading if a queue is full.
+    def _connection_lost(self):
+
+        self._transport = None
+
+        for waiters in self._waiters.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+        self._waiters = {}
+
+        for queues in self._streams.values():
+            for queue in queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    # Convert a parsed fragment into its response entity, then hand it to
+    # any waiting commands and notification streams
+    def _handle_fragment(self, tree):
+
+        if self.debug:
+            ElementTree.dump(tree)
+
+        response_type = tree.tag
+        klass = response_entities.Entity.tag_to_class(response_type)
+        if klass is None:
+            if self.debug:
+                print("Unsupported tag " + response_type)
+            return
+
+        try:
+            entity = klass(tree)
+        except (ValueError, TypeError) as e:
+            if self.debug:
+                print("Invalid " + response_type + ": " + str(e))
+            self.fragments_invalid += 1
+            return
+
+        self._data[response_type] = entity
+        self._meter_data[response_entities.meter_key(response_type, getattr(entity, 'meter_mac', None))] = entity
+
+        for future in self._waiters.pop(response_type, []):
+            if not future.done():
+                future.set_result(entity)
+
+        for tag in (response_type, None):
+            for queue in self._streams.get(tag, []):
+                if not queue.full():
+                    queue.put_nowait(entity)
+
+
+# Protocol connecting the serial transport to an AsyncEmu instance
+class _EmuProtocol(asyncio.Protocol):
+
+    def __init__(self, emu):
+        self._emu = emu
+
+    def data_received(self, data):
+        self._emu._data_received(data)
+
+    def connection_lost(self, exc):
+        self._emu._connection_lost()
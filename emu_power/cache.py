@@ -0,0 +1,122 @@
+import threading
+import time
+from concurrent.futures import Future
+
+# Default time to live in seconds for cached responses, keyed by root tag.
+# Only these slow changing responses are cached.
+DEFAULT_TTLS = {
+    'DeviceInfo': 3600,
+    'MeterList': 300,
+    'MeterInfo': 300,
+    'NetworkInfo': 60,
+    'ScheduleInfo': 300
+}
+
+# Cached tags made stale by each command
+INVALIDATED_BY = {
+    'set_meter_info': ('MeterInfo', 'MeterList'),
+    'set_schedule': ('ScheduleInfo',),
+    'set_schedule_default': ('ScheduleInfo',),
+    'restart': tuple(DEFAULT_TTLS),
+    'factory_reset': tuple(DEFAULT_TTLS)
+}
+
+
+# Cache of recent responses to slow changing queries (device, meter and
+# network info, schedules, the meter list). Entries are keyed by root tag,
+# meter and schedule event, and expire after a per tag time to live. Any
+# matching response, solicited or not, refreshes the entry, and concurrent
+# identical queries are joined so only one goes out to the device.
+class ResponseCache:
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+        self._entries = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    # Get the cached response for a query, or run fetch to get it. Fetch is
+    # only run by one caller at a time per key; others wait for its result.
+    def get_or_fetch(self, return_class, params, fetch):
+
+        tag = return_class.tag_name()
+        if tag not in self.ttls:
+            return fetch()
+
+        params = params or {}
+        key = self._key(tag, params.get('MeterMacId'), params.get('Event'))
+
+        # A schedule query without an event returns a response per event,
+        # which does not fit in one entry
+        if tag == 'ScheduleInfo' and key[2] is None:
+            return fetch()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                return entry[0]
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.joined += 1
+
+        if not owner:
+            return future.result()
+
+        result = None
+        try:
+            result = fetch()
+            if result is not None and result is not True:
+                self._store(key, result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_result(result)
+
+        return result
+
+    # Refresh the cache from a response as it is parsed
+    def update(self, entity):
+
+        tag = entity.tag_name()
+        if tag not in self.ttls:
+            return
+
+        meter_mac = getattr(entity, 'meter_mac', None)
+        event = getattr(entity, 'event', None)
+        self._store(self._key(tag, meter_mac, event), entity)
+
+        # Also answer queries that did not name a meter
+        if meter_mac is not None:
+            self._store(self._key(tag, None, event), entity)
+
+    # Drop the entries made stale by a command
+    def invalidate_for(self, command):
+        tags = INVALIDATED_BY.get(command)
+        if tags is not None:
+            self.invalidate(*tags)
+
+    # Drop all entries for the given tags, or everything if none are given
+    def invalidate(self, *tags):
+        with self._lock:
+            if not tags:
+                self._entries = {}
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if k[0] not in tags}
+
+    def _store(self, key, entity):
+        with self._lock:
+            self._entries[key] = (entity, time.time() + self.ttls[key[0]])
+
+    def _key(self, tag, meter_mac, event):
+        return tag, None if meter_mac is None else meter_mac.lower(), event
@@ -0,0 +1,90 @@
+import struct
+import threading
+import time
+
+# Capture files hold the raw bytes exchanged with the device, for debugging
+# and offline reprocessing. After a short header, the file is a sequence of
+# records, each a fixed size little endian header of (Unix time as a double,
+# direction, payload length) followed by the payload. Files are only ever
+# appended to, so a capture can be extended across several sessions.
+MAGIC = b'EMUCAP1\n'
+RECORD_HEADER = struct.Struct('<dBI')
+
+# Directions of a record
+RECEIVED = 0
+SENT = 1
+
+
+# Appends records to a capture file. Writes go through a large buffer so
+# recording costs little on the reader thread; call flush() to force them
+# out. Safe to use from several threads.
+class CaptureWriter:
+
+    def __init__(self, path, buffer_size=65536):
+        self.path = path
+        self._file = open(path, 'ab', buffering=buffer_size)
+        self._lock = threading.Lock()
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def record(self, direction, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(timestamp, direction, len(data)))
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Iterate over the (timestamp, direction, data) records in a capture file.
+# A record cut short at the end of the file, as left by a crash, is ignored.
+def read_capture(path):
+
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a capture file")
+
+        while True:
+            header = fh.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            data = fh.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
+
+
+# Feed the data received in a capture back through an Emu object's parse
+# pipeline, exactly as if it had just been read from the port. Subscribers,
+# history and get_data all see it as live data. By default this runs as
+# fast as possible; set realtime to reproduce the original timing, scaled
+# by speed. Returns the number of entities produced.
+def replay(path, emu, realtime=False, speed=1.0):
+
+    count = 0
+    first_capture = None
+    first_replay = None
+
+    for timestamp, direction, data in read_capture(path):
+        if direction != RECEIVED:
+            continue
+
+        if realtime:
+            if first_capture is None:
+                first_capture = timestamp
+                first_replay = time.time()
+            delay = first_replay + (timestamp - first_capture) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        count += len(emu._receive(data))
+
+    return count
@@ -0,0 +1,217 @@
+from xml.etree import ElementTree
+from emu_power import response_entities
+
+
+# Convenience methods for the commands supported by the device, shared by the
+# synchronous and asyncio clients. Classes using this mixin provide the
+# issue_command method that actually sends the command; whatever it returns
+# (an entity, or an awaitable for the asyncio client) is passed straight back.
+class Commands:
+
+    # Build the serialized XML for a command. Params with a value of None
+    # are left out.
+    def _build_command(self, command, params=None):
+
+        root = ElementTree.Element('Command')
+        name_field = ElementTree.SubElement(root, 'Name')
+        name_field.text = command
+
+        if params is not None:
+            for k, v in params.items():
+                if v is not None:
+                    field = ElementTree.SubElement(root, k)
+                    field.text = v
+
+        return ElementTree.tostring(root)
+
+    # Issue a query for information that rarely changes. Clients that cache
+    # responses override this; by default it is the same as issue_command.
+    def _query(self, command, params=None, return_class=None):
+        return self.issue_command(command, params, return_class)
+
+    # Convert boolean to Y/N for commands
+    def _format_yn(self, value):
+        if value is None:
+            return None
+        if value:
+            return 'Y'
+        else:
+            return 'N'
+
+    # Convert an integer into a hex string
+    def _format_hex(self, num, digits=8):
+        return "0x{:0{digits}x}".format(num, digits=digits)
+
+    # Check if an event is a valid value
+    def _check_valid_event(self, event, allow_none=True):
+        enum = ['time', 'summation', 'billing_period', 'block_period',
+                'message', 'price', 'scheduled_prices', 'demand']
+        if allow_none:
+            enum.append(None)
+        if event not in enum:
+            raise ValueError('Invalid event specified')
+
+    # The following are convenience methods for sending commands. Commands
+    # can also be sent manually using the generic issue_command method.
+
+    #################################
+    #         Raven Commands        #
+    #################################
+
+    def restart(self):
+        return self.issue_command('restart')
+
+    # Dangerous! Will decommission device!
+    def factory_reset(self):
+        return self.issue_command('factory_reset')
+
+    def get_connection_status(self):
+        return self.issue_command('get_connection_status', return_class=response_entities.ConnectionStatus)
+
+    def get_device_info(self):
+        return self._query('get_device_info', return_class=response_entities.DeviceInfo)
+
+    def get_schedule(self, mac=None, event=None):
+        self._check_valid_event(event)
+        opts = {'MeterMacId': mac, 'Event': event}
+        return self._query('get_schedule', opts, return_class=response_entities.ScheduleInfo)
+
+    def set_schedule(self, mac=None, event=None, frequency=10, enabled=True):
+        self._check_valid_event(event, allow_none=False)
+        opts = {
+            'MeterMacId': mac,
+            'Event': event,
+            'Frequency': self._format_hex(frequency),
+            'Enabled': self._format_yn(enabled)
+        }
+        return self.issue_command('set_schedule', opts)
+
+    def set_schedule_default(self, mac=None, event=None):
+        self._check_valid_event(event)
+        opts = {'MeterMacId': mac, 'Event': event}
+        return self.issue_command('set_schedule_default', opts)
+
+    def get_meter_list(self):
+        return self._query('get_meter_list', return_class=response_entities.MeterList)
+
+    ##########################
+    #     Meter Commands     #
+    ##########################
+
+    def get_meter_info(self, mac=None):
+        opts = {'MeterMacId': mac}
+        return self._query('get_meter_info', opts, return_class=response_entities.MeterInfo)
+
+    def get_network_info(self):
+        return self._query('get_network_info', return_class=response_entities.NetworkInfo)
+
+    def set_meter_info(self, mac=None, nickname=None, account=None, auth=None, host=None, enabled=None):
+
+        opts = {
+            'MeterMacId': mac,
+            'NickName': nickname,
+            'Account': account,
+            'Auth': auth,
+            'Host': host,
+            'Enabled': self._format_yn(enabled)
+        }
+        return self.issue_command('set_meter_info', opts)
+
+    ############################
+    #       Time Commands      #
+    ############################
+
+    def get_time(self, mac=None, refresh=True):
+        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
+        return self.issue_command('get_time', opts, return_class=response_entities.TimeCluster)
+
+    def get_message(self, mac=None, refresh=True):
+        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
+        return self.issue_command('get_message', opts, return_class=response_entities.MessageCluster)
+
+    def confirm_message(self, mac=None, message_id=None):
+
+        if message_id is None:
+            raise ValueError('Message id is required')
+
+        opts = {'MeterMacId': mac, 'Id': self._format_hex(message_id)}
+        return self.issue_command('confirm_message', opts)
+
+    #########################
+    #     Price Commands    #
+    #########################
+
+    def get_current_price(self, mac=None, refresh=True):
+        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
+        return self.issue_command('get_current_price', opts, return_class=response_entities.PriceCluster)
+
+    # Price is in cents, w/ decimals (e.g. "24.373")
+    def set_current_price(self, mac=None, price="0.0"):
+
+        parts = price.split(".", 1)
+        if len(parts) == 1:
+            trailing = 2
+            price = int(parts[0])
+        else:
+            trailing = len(parts[1]) + 2
+            price = int(parts[0] + parts[1])
+
+        opts = {
+            'MeterMacId': mac,
+            'Price': self._format_hex(price),
+            'TrailingDigits': self._format_hex(trailing, digits=2)
+        }
+        return self.issue_command('set_current_price', opts)
+
+    ###############################
+    #   Simple Metering Commands  #
+    ###############################
+
+    def get_instantaneous_demand(self, mac=None, refresh=True):
+        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
+        return self.issue_command('get_instantaneous_demand', opts, return_class=response_entities.InstantaneousDemand)
+
+    def get_current_summation_delivered(self, mac=None, refresh=True):
+        opts = {'MeterMacId': mac, 'Refresh': self._format_yn(refresh)}
+        return self.issue_command('get_current_summation_delivered', opts, return_class=response_entities.CurrentSummationDelivered)
+
+    def get_current_period_usage(self, mac=None):
+        opts = {'MeterMacId': mac}
+        return self.issue_command('get_current_period_usage', opts, return_class=response_entities.CurrentPeriodUsage)
+
+    def get_last_period_usage(self, mac=None):
+        opts = {'MeterMacId': mac}
+        return self.issue_command('get_last_period_usage', opts, return_class=response_entities.LastPeriodUsage)
+
+    # Get up to 12 intervals of consumption (or with channel 'Received',
+    # generation) ending at end_time, a Unix time, or the most recent
+    # intervals if it is None. See also Emu.get_profile_history.
+    def get_profile_data(self, mac=None, number_of_periods=12, end_time=None, channel='Delivered'):
+
+        if not 1 <= number_of_periods <= 12:
+            raise ValueError('Number of periods must be between 1 and 12')
+        if channel not in ('Delivered', 'Received'):
+            raise ValueError('Invalid interval channel specified')
+
+        if end_time is not None:
+            end_time = self._format_hex(response_entities.unix_to_rainforest(end_time))
+
+        opts = {
+            'MeterMacId': mac,
+            'NumberOfPeriods': self._format_hex(number_of_periods, digits=2),
+            'EndTime': end_time,
+            'IntervalChannel': channel
+        }
+        return self.issue_command('get_profile_data', opts, return_class=response_entities.ProfileData)
+
+    def close_current_period(self, mac=None):
+        opts = {'MeterMacId': mac}
+        return self.issue_command('close_current_period', opts)
+
+    def set_fast_poll(self, mac=None, frequency=4, duration=20):
+        opts = {
+            'MeterMacId': mac,
+            'Frequency': self._format_hex(frequency, digits=4),
+            'Duration': self._format_hex(duration, digits=4)
+        }
+        return self.issue_command('set_fast_poll', opts)
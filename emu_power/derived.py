@@ -0,0 +1,189 @@
+import threading
+import time
+from collections import deque
+from emu_power import response_entities
+
+# Rolling window lengths in seconds used by default
+WINDOWS = (60, 900, 3600)
+
+
+# Sum, count, minimum and maximum of the values added in the last seconds,
+# by the timestamps they were added with. Minimum and maximum are kept in
+# monotonic queues, so adding a value is amortized O(1) and reading any of
+# them is O(1), however many values are in the window.
+class RollingWindow:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.total = 0.0
+        self._values = deque()
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, timestamp, value):
+
+        self._values.append((timestamp, value))
+        self.total += value
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+
+    # Drop values that are out of the window as of the given time
+    def advance(self, now):
+        cutoff = now - self.seconds
+        while self._values and self._values[0][0] <= cutoff:
+            self.total -= self._values.popleft()[1]
+        if not self._values:
+            self.total = 0.0
+        while self._min and self._min[0][0] <= cutoff:
+            self._min.popleft()
+        while self._max and self._max[0][0] <= cutoff:
+            self._max.popleft()
+
+    def summary(self):
+
+        if not self._values:
+            return {'count': 0, 'total': 0.0, 'min': None, 'max': None, 'mean': None, 'peak_time': None}
+
+        return {
+            'count': len(self._values),
+            'total': self.total,
+            'min': self._min[0][1],
+            'max': self._max[0][1],
+            'mean': self.total / len(self._values),
+            'peak_time': self._max[0][0]
+        }
+
+
+# Incrementally maintained rollups of the readings from a meter, so
+# dashboards can read them in constant time rather than rescanning history.
+# For each window length, keeps the min, max and mean demand in kW with the
+# time of the peak, and the energy in kWh and its cost from the deltas
+# between summation readings. Cost uses the most recent PriceCluster, so it
+# is only counted once a price has been received.
+#
+# A summation reading lower than the last one is taken as the meter's
+# counter having been reset, and is counted as the energy used since zero.
+# Set mac to only use readings from that meter.
+class DerivedMetrics:
+
+    def __init__(self, windows=WINDOWS, mac=None):
+
+        self.windows = tuple(windows)
+        self.mac = None if mac is None else mac.lower()
+
+        self._demand = [RollingWindow(w) for w in self.windows]
+        self._energy = [RollingWindow(w) for w in self.windows]
+        self._cost = [RollingWindow(w) for w in self.windows]
+
+        self.demand = None
+        self.price = None
+        self.energy_total = 0.0
+        self.cost_total = 0.0
+        self.counter_resets = 0
+
+        self._last_summation = None
+        self._latest = None
+        self._lock = threading.Lock()
+
+        self._handlers = {
+            'InstantaneousDemand': self._add_demand,
+            'CurrentSummationDelivered': self._add_summation,
+            'PriceCluster': self._add_price
+        }
+
+    # Subscribe to the entities used from an Emu object
+    def attach(self, emu):
+        return [emu.subscribe(response_entities.Entity.tag_to_class(tag), self.update) for tag in self._handlers]
+
+    # Add an entity. Entities of other types or meters are ignored.
+    def update(self, entity):
+
+        handler = self._handlers.get(entity.tag_name())
+        if handler is None:
+            return
+        if self.mac is not None and (entity.meter_mac or '').lower() != self.mac:
+            return
+
+        timestamp = response_entities.rainforest_to_unix(entity.timestamp)
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            handler(timestamp, entity)
+
+            # Every window moves on with the newest reading of any type
+            if self._latest is None or timestamp > self._latest:
+                self._latest = timestamp
+            for window in self._demand + self._energy + self._cost:
+                window.advance(self._latest)
+
+    def _add_demand(self, timestamp, entity):
+        self.demand = entity.reading
+        for window in self._demand:
+            window.add(timestamp, entity.reading)
+
+    def _add_summation(self, timestamp, entity):
+
+        last = self._last_summation
+        self._last_summation = entity.reading
+        if last is None:
+            return
+
+        delta = entity.reading - last
+        if delta < 0:
+            self.counter_resets += 1
+            delta = entity.reading
+
+        self.energy_total += delta
+        for window in self._energy:
+            window.add(timestamp, delta)
+
+        if self.price is not None:
+            cost = delta * self.price
+            self.cost_total += cost
+            for window in self._cost:
+                window.add(timestamp, cost)
+
+    def _add_price(self, timestamp, entity):
+        if entity.price is not None:
+            self.price = response_entities.scale_price(entity.price, entity.trailing_digits)
+
+    # Demand statistics over the given window length, as a dict of count,
+    # min, max, mean and peak_time (plus total, the sum of the readings)
+    def demand_window(self, seconds):
+        with self._lock:
+            return self._demand[self.windows.index(seconds)].summary()
+
+    # Energy in kWh used in the given window length
+    def energy_window(self, seconds):
+        with self._lock:
+            return self._energy[self.windows.index(seconds)].total
+
+    # Cost of the energy used in the given window length
+    def cost_window(self, seconds):
+        with self._lock:
+            return self._cost[self.windows.index(seconds)].total
+
+    # Everything at once, with windowed values keyed by window length
+    def summary(self):
+        with self._lock:
+            return {
+                'demand': self.demand,
+                'price': self.price,
+                'energy_total': self.energy_total,
+                'cost_total': self.cost_total,
+                'counter_resets': self.counter_resets,
+                'windows': {
+                    seconds: {
+                        'demand': demand.summary(),
+                        'energy': energy.total,
+                        'cost': cost.total
+                    } for seconds, demand, energy, cost in zip(self.windows, self._demand, self._energy, self._cost)
+                }
+            }
@@ -0,0 +1,315 @@
+import argparse
+import json
+import queue
+import threading
+from array import array
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from emu_power import Emu, response_entities
+from emu_power.commands import Commands
+
+# Commands that can be sent through the gateway by default: every
+# convenience method except the one that decommissions the device
+DEFAULT_COMMANDS = frozenset(
+    name for name in vars(Commands) if not name.startswith('_') and name != 'factory_reset'
+)
+
+
+# Convert an entity into a dict that can be encoded as JSON
+def entity_to_dict(entity):
+    result = {'type': entity.tag_name()}
+    for name in entity.field_names():
+        value = getattr(entity, name, None)
+        if isinstance(value, array):
+            value = [None if v != v else v for v in value]
+        result[name] = value
+    return result
+
+
+# Serves one device to any number of local clients over HTTP, so that only
+# the gateway needs to open the serial port:
+#
+#   GET  /data               latest entity of every type, keyed by root tag
+#   GET  /data/<tag>?mac=    latest entity of one type, optionally per meter
+#   GET  /meters             MACs of the meters heard from
+#   GET  /stats              counters from Emu.stats()
+#   GET  /metrics            the same in the Prometheus text format
+#   GET  /events?tag=        server-sent events, one per entity received
+#   POST /command/<name>     run a command method, with a JSON object of
+#                            keyword arguments as the body
+#
+# Commands from every client go through a single queue and are sent one at
+# a time, so the serial link never sees more than one in flight from the
+# gateway. Each entity is encoded once and handed to every event stream
+# without blocking; a client too slow to keep up with its queue of
+# event_queue_size misses events rather than holding up the others.
+class EmuGateway:
+
+    def __init__(self, emu, host='127.0.0.1', port=8080, commands=DEFAULT_COMMANDS,
+                 event_queue_size=1000, command_timeout=None):
+
+        self.emu = emu
+        self.commands = frozenset(commands)
+        self.event_queue_size = event_queue_size
+        self.command_timeout = emu.timeout if command_timeout is None else command_timeout
+        self.events_dropped = 0
+
+        self._server = _Server((host, port), _Handler)
+        self._server.gateway = self
+
+        self._commands = queue.Queue()
+        self._streams = []
+        self._streams_lock = threading.Lock()
+        self._subscription = None
+        self._threads = []
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+
+        if self._threads:
+            return
+
+        self._subscription = self.emu.subscribe_all(self._publish)
+        for target in (self._server.serve_forever, self._command_thread):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+
+        if not self._threads:
+            return
+
+        self.emu.unsubscribe(self._subscription)
+        self._subscription = None
+
+        self._server.shutdown()
+        self._commands.put(None)
+        with self._streams_lock:
+            for stream in self._streams:
+                self._offer(stream, None)
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._server.server_close()
+
+    # Queue a command to be run by the command thread, returning a Future
+    # for its result
+    def submit(self, name, kwargs):
+
+        if name not in self.commands:
+            raise ValueError("Unknown command " + name)
+
+        future = Future()
+        self._commands.put((name, kwargs, future))
+        return future
+
+    def _command_thread(self):
+        while True:
+
+            item = self._commands.get()
+            if item is None:
+                return
+
+            name, kwargs, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                # Wait on each command before the next, whether or not the
+                # Emu object is synchronous
+                if self.emu.synchronous:
+                    result = getattr(self.emu, name)(**kwargs)
+                else:
+                    result = getattr(self.emu.pipeline(), name)(**kwargs).result()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    # Called on the reader thread for every entity
+    def _publish(self, entity):
+
+        with self._streams_lock:
+            streams = list(self._streams)
+        if not streams:
+            return
+
+        tag = entity.tag_name()
+        event = 'event: {}\ndata: {}\n\n'.format(tag, json.dumps(entity_to_dict(entity))).encode('UTF-8')
+        for stream in streams:
+            if stream.tag is None or stream.tag == tag:
+                self._offer(stream, event)
+
+    def _offer(self, stream, event):
+        try:
+            stream.queue.put_nowait(event)
+        except queue.Full:
+            self.events_dropped += 1
+
+    def _open_stream(self, tag):
+        stream = _Stream(tag, self.event_queue_size)
+        with self._streams_lock:
+            self._streams.append(stream)
+        return stream
+
+    def _close_stream(self, stream):
+        with self._streams_lock:
+            self._streams.remove(stream)
+
+
+class _Stream:
+
+    def __init__(self, tag, queue_size):
+        self.tag = tag
+        self.queue = queue.Queue(queue_size)
+
+
+# HTTPServer handling each request on its own thread, as
+# ThreadingHTTPServer does from Python 3.7
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Seconds between keepalive comments on idle event streams, which is
+    # also how long it takes to notice a client has gone
+    KEEPALIVE = 15
+
+    def log_message(self, format, *args):
+        if self.server.gateway.emu.debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+
+        gateway = self.server.gateway
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split('/') if p]
+
+        if parts == ['data']:
+            self._send_json({tag: entity_to_dict(e) for tag, e in list(gateway.emu._data.items())})
+        elif len(parts) == 2 and parts[0] == 'data':
+            klass = response_entities.Entity.tag_to_class(parts[1])
+            if klass is None:
+                return self._send_error(404, "Unknown tag " + parts[1])
+            entity = gateway.emu.get_data(klass, query.get('mac', [None])[0])
+            if entity is None:
+                return self._send_error(404, "No data for " + parts[1])
+            self._send_json(entity_to_dict(entity))
+        elif parts == ['meters']:
+            self._send_json(gateway.emu.get_meters())
+        elif parts == ['stats']:
+            stats = gateway.emu.stats()
+            stats['events_dropped'] = gateway.events_dropped
+            self._send_json(stats)
+        elif parts == ['metrics']:
+            self._send_text(gateway.emu.prometheus_metrics(), 'text/plain; version=0.0.4')
+        elif parts == ['events']:
+            self._stream_events(query.get('tag', [None])[0])
+        else:
+            self._send_error(404, "Not found")
+
+    def do_POST(self):
+
+        gateway = self.server.gateway
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        if len(parts) != 2 or parts[0] != 'command':
+            return self._send_error(404, "Not found")
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            kwargs = json.loads(self.rfile.read(length).decode('UTF-8') or '{}')
+            if not isinstance(kwargs, dict):
+                raise ValueError("Body must be a JSON object")
+            future = gateway.submit(parts[1], kwargs)
+        except ValueError as e:
+            return self._send_error(400, str(e))
+
+        try:
+            result = future.result(gateway.command_timeout + 5)
+        except (ValueError, TypeError) as e:
+            # Commands raise ValueError for bad arguments, but also when the
+            # port is down
+            return self._send_error(503 if gateway.emu._serial_port is None else 400, str(e))
+        except Exception as e:
+            return self._send_error(503, str(e))
+
+        if result is None:
+            return self._send_error(504, "No response from device")
+        if isinstance(result, response_entities.Entity):
+            result = entity_to_dict(result)
+        self._send_json({'result': result})
+
+    def _stream_events(self, tag):
+
+        gateway = self.server.gateway
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        stream = gateway._open_stream(tag)
+        try:
+            while True:
+                try:
+                    event = stream.queue.get(timeout=self.KEEPALIVE)
+                except queue.Empty:
+                    event = b': keepalive\n\n'
+                if event is None:
+                    return
+                self.wfile.write(event)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            gateway._close_stream(stream)
+
+    def _send_json(self, value, status=200):
+        self._send_text(json.dumps(value), 'application/json', status)
+
+    def _send_text(self, text, content_type, status=200):
+        body = text.encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json({'error': message}, status)
+
+
+def main(args=None):
+
+    arg_parser = argparse.ArgumentParser(description="Serve an EMU-2 to local clients over HTTP")
+    arg_parser.add_argument('port_name', help="serial port of the device")
+    arg_parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    arg_parser.add_argument('--http-port', type=int, default=8080, help="port to listen on")
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args(args)
+
+    emu = Emu(debug=args.debug, synchronous=True, cache=True, reconnect=True)
+    if not emu.start_serial(args.port_name):
+        arg_parser.error("could not open " + args.port_name)
+
+    gateway = EmuGateway(emu, args.host, args.http_port)
+    gateway.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+        emu.stop_serial()
+
+
+if __name__ == '__main__':
+    main()
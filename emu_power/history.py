@@ -0,0 +1,101 @@
+import threading
+import time
+from array import array
+from emu_power import response_entities
+
+# Response types that carry a numeric reading, and are therefore recorded
+# in history when it is enabled
+HISTORY_CLASSES = (
+    response_entities.InstantaneousDemand,
+    response_entities.CurrentSummationDelivered,
+    response_entities.CurrentPeriodUsage
+)
+
+
+# Fixed size ring buffer of (timestamp, reading) pairs for a single response
+# type. Values are stored in flat arrays of doubles rather than as entity
+# objects, so a large history costs 16 bytes per reading. Every reading is
+# given a sequence number, which consumers can use as a cursor to pick up
+# exactly where their last read left off.
+class History:
+
+    def __init__(self, size):
+
+        if size < 1:
+            raise ValueError("History size must be at least 1")
+
+        self.size = size
+        self._timestamps = array('d', bytes(8 * size))
+        self._readings = array('d', bytes(8 * size))
+
+        # Total number of readings ever appended. The oldest retained reading
+        # has sequence number max(0, _count - size).
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    # Record the reading carried by an entity, using the device timestamp
+    # if it has one and the time of receipt otherwise
+    def append_entity(self, entity):
+        timestamp = response_entities.rainforest_to_unix(getattr(entity, 'timestamp', None))
+        if timestamp is None:
+            timestamp = time.time()
+        self.append(timestamp, entity.reading)
+
+    def append(self, timestamp, reading):
+        with self._lock:
+            index = self._count % self.size
+            self._timestamps[index] = timestamp
+            self._readings[index] = reading
+            self._count += 1
+
+    # Get all readings appended after the given cursor, along with the cursor
+    # to pass in next time. Start with a cursor of 0. If the consumer has
+    # fallen so far behind that readings were overwritten, reading resumes
+    # from the oldest one still held.
+    def since(self, cursor=0):
+        with self._lock:
+            first = max(cursor, self._count - self.size, 0)
+            return self._slice(first, self._count), self._count
+
+    # Get all held readings with start <= timestamp <= end, oldest first.
+    # Either bound may be None. Readings are assumed to arrive in timestamp
+    # order, so the bounds are found by binary search.
+    def range(self, start=None, end=None):
+        with self._lock:
+            oldest = max(self._count - self.size, 0)
+            first = oldest if start is None else self._bisect(oldest, start, False)
+            last = self._count if end is None else self._bisect(oldest, end, True)
+            return self._slice(first, max(first, last))
+
+    # Copy of all held timestamps and readings as two arrays of doubles,
+    # oldest first
+    def arrays(self):
+        with self._lock:
+            if self._count <= self.size:
+                return self._timestamps[:self._count], self._readings[:self._count]
+            split = self._count % self.size
+            return (self._timestamps[split:] + self._timestamps[:split],
+                    self._readings[split:] + self._readings[:split])
+
+    # Find the first sequence number whose timestamp is >= value, or > value
+    # if right is set
+    def _bisect(self, low, value, right):
+        high = self._count
+        while low < high:
+            mid = (low + high) // 2
+            ts = self._timestamps[mid % self.size]
+            if ts < value or (right and ts == value):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    # Readings for sequence numbers in [first, last) as a list of tuples
+    def _slice(self, first, last):
+        return [
+            (self._timestamps[seq % self.size], self._readings[seq % self.size])
+            for seq in range(first, last)
+        ]
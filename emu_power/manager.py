@@ -0,0 +1,270 @@
+import selectors
+import threading
+import time
+import serial
+
+
+# Polls many EMU-2 devices from a single thread. Each device is represented
+# by an ordinary Emu object, so all of the usual commands are available via
+# device(name), but instead of each one blocking a thread on its own serial
+# port, one reader thread waits on every port at once with a selector and
+# routes the data to the right device.
+#
+# Ports that fail are closed and reopened in the background with exponential
+# backoff, so a device being unplugged does not affect any of the others.
+# Selecting on serial ports requires a POSIX platform.
+class EmuManager:
+
+    # Reconnect delay is the time in seconds before the first attempt to
+    # reopen a failed port, doubling on each failure up to max_reconnect_delay.
+    def __init__(self, debug=False, reconnect_delay=1, max_reconnect_delay=60):
+
+        self.debug = debug
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self._devices = {}
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+
+        # Subscriptions as (callback, device name, root tag) where the name
+        # and tag may be None to match anything
+        self._subscribers = []
+
+        self._thread_handle = None
+        self._stop_thread = False
+
+        # Exceptions raised by subscriber callbacks, which are otherwise
+        # ignored
+        self.callback_errors = 0
+
+    # Add a device to be polled, returning its Emu object. Any extra keyword
+    # arguments are passed to the Emu constructor. Devices may be added
+    # before or after the manager is started.
+    def add_device(self, name, port_name, **kwargs):
+
+        # Imported here since the package imports this module
+        from emu_power import Emu
+
+        with self._lock:
+            if name in self._devices:
+                raise ValueError("Device " + name + " already exists")
+            device = _Device(name, port_name, Emu(debug=self.debug, **kwargs))
+            self._devices[name] = device
+
+        return device.emu
+
+    # Stop polling a device and close its port
+    def remove_device(self, name):
+        with self._lock:
+            device = self._devices.pop(name)
+            self._close(device)
+
+    # Get the Emu object for a device, for issuing commands
+    def device(self, name):
+        return self._devices[name].emu
+
+    def device_names(self):
+        return list(self._devices)
+
+    # Get the most recent response of the given class from a device
+    def get_data(self, device, klass, mac=None):
+        return self._devices[device].emu.get_data(klass, mac)
+
+    # Call callback(device_name, entity) from the reader thread for every
+    # entity received. Restrict to one device and/or one response class by
+    # passing them. Callbacks must be quick, since they hold up reading
+    # from every device. Exceptions they raise are counted in
+    # callback_errors and otherwise ignored. Returns a handle for
+    # unsubscribe.
+    def subscribe(self, callback, device=None, klass=None):
+        subscription = (callback, device, None if klass is None else klass.tag_name())
+        with self._lock:
+            self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.remove(subscription)
+
+    # Health of one device, or of all devices keyed by name
+    def get_health(self, device=None):
+        if device is not None:
+            return self._devices[device].health()
+        return {name: d.health() for name, d in list(self._devices.items())}
+
+    # Start the reader thread
+    def start(self):
+
+        if self._thread_handle is not None:
+            return
+
+        self._stop_thread = False
+        self._thread_handle = threading.Thread(target=self._reader_thread)
+        self._thread_handle.start()
+
+    # Stop the reader thread and close all ports
+    def stop(self):
+
+        if self._thread_handle is None:
+            return
+
+        self._stop_thread = True
+        self._thread_handle.join()
+        self._thread_handle = None
+
+        with self._lock:
+            for device in self._devices.values():
+                self._close(device)
+
+    # Single thread servicing all ports. If it fails unexpectedly, every
+    # port is closed so that get_health does not report devices that are
+    # no longer being read as connected.
+    def _reader_thread(self):
+        try:
+            self._read_loop()
+        except Exception as e:
+            if self.debug:
+                print("Reader thread failed: " + repr(e))
+            with self._lock:
+                for device in self._devices.values():
+                    self._close(device)
+                    device.last_error = "Reader thread failed: " + repr(e)
+
+    # Selecting wakes up as soon as any port has data, and otherwise at
+    # least once a second to check for ports due to be reopened and for a
+    # stop request.
+    def _read_loop(self):
+        while not self._stop_thread:
+
+            self._open_due_ports()
+
+            if not self._selector.get_map():
+                time.sleep(0.1)
+                continue
+
+            for key, _ in self._selector.select(timeout=1):
+                self._read(key.data)
+
+    # Read whatever is waiting on a port and route it to its device. Any
+    # error while handling the data fails that device only.
+    def _read(self, device):
+
+        # The device may have been removed since the select returned
+        port = device.port
+        if port is None:
+            return
+
+        try:
+            data = port.read(port.in_waiting or 1)
+        except (serial.serialutil.SerialException, OSError) as e:
+            with self._lock:
+                self._fail(device, e)
+            return
+
+        if len(data) == 0:
+            return
+
+        device.bytes_read += len(data)
+        device.last_data = time.time()
+        try:
+            entities = device.emu._receive(data)
+        except Exception as e:
+            with self._lock:
+                self._fail(device, "Failed handling data: " + repr(e))
+            return
+
+        if entities and self._subscribers:
+            subscribers = list(self._subscribers)
+            for entity in entities:
+                tag = entity.tag_name()
+                for callback, name, sub_tag in subscribers:
+                    if (name is None or name == device.name) and (sub_tag is None or sub_tag == tag):
+                        self._call(callback, device, entity)
+
+    # Run a subscriber callback, so that one that raises cannot stop the
+    # reader thread and with it every device
+    def _call(self, callback, device, entity):
+        try:
+            callback(device.name, entity)
+        except Exception as e:
+            self.callback_errors += 1
+            if self.debug:
+                print("Subscriber raised " + repr(e))
+
+    # Try to open any ports that are closed and due for a retry
+    def _open_due_ports(self):
+
+        now = time.time()
+        with self._lock:
+            for device in self._devices.values():
+                if device.port is not None or device.next_attempt > now:
+                    continue
+
+                try:
+                    port = serial.Serial(device.port_name, 115200, timeout=0)
+                except (serial.serialutil.SerialException, OSError) as e:
+                    self._fail(device, e)
+                    continue
+
+                if device.last_error is not None:
+                    device.reconnects += 1
+
+                device.port = port
+                device.failures = 0
+                device.emu._attach(port)
+                self._selector.register(port.fileno(), selectors.EVENT_READ, device)
+
+    # Close a failed port and schedule it to be reopened. Must be called
+    # with the lock held.
+    def _fail(self, device, error):
+
+        if self.debug:
+            print("Device " + device.name + " failed: " + str(error))
+
+        self._close(device)
+        device.last_error = str(error)
+        delay = min(self.reconnect_delay * (2 ** device.failures), self.max_reconnect_delay)
+        device.failures += 1
+        device.next_attempt = time.time() + delay
+
+    # Must be called with the lock held
+    def _close(self, device):
+
+        if device.port is None:
+            return
+
+        self._selector.unregister(device.port.fileno())
+        device.emu._detach()
+        try:
+            device.port.close()
+        except (serial.serialutil.SerialException, OSError):
+            pass
+        device.port = None
+
+
+# Book-keeping for a single device managed by EmuManager
+class _Device:
+
+    def __init__(self, name, port_name, emu):
+        self.name = name
+        self.port_name = port_name
+        self.emu = emu
+        self.port = None
+
+        self.bytes_read = 0
+        self.last_data = None
+        self.last_error = None
+        self.failures = 0
+        self.reconnects = 0
+        self.next_attempt = 0
+
+    def health(self):
+        return {
+            'connected': self.port is not None,
+            'bytes_read': self.bytes_read,
+            'last_data': self.last_data,
+            'last_error': self.last_error,
+            'reconnects': self.reconnects,
+            'next_attempt': None if self.port is not None else self.next_attempt
+        }
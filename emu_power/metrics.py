@@ -0,0 +1,124 @@
+from bisect import bisect_left
+
+# Histogram bucket upper bounds in seconds
+PARSE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Fixed bucket histogram. Observing a value is a binary search and an
+# increment, so it is cheap enough for the reader thread.
+class Histogram:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Cumulative counts per upper bound, as in Prometheus, ending with +Inf
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+# Counters and histograms for the hot paths in Emu. Only created when
+# metrics are enabled; when they are not, Emu skips all of this with a
+# single check for None. Updated from the reader thread only.
+class Metrics:
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.fragments_parsed = {}
+        self.unsupported_tags = {}
+        self.parse_seconds = Histogram(PARSE_BUCKETS)
+        self.command_latency = {}
+
+    def record_fragment(self, tag, seconds):
+        self.fragments_parsed[tag] = self.fragments_parsed.get(tag, 0) + 1
+        self.parse_seconds.observe(seconds)
+
+    def record_unsupported(self, tag):
+        self.unsupported_tags[tag] = self.unsupported_tags.get(tag, 0) + 1
+
+    def record_command(self, command, seconds):
+        histogram = self.command_latency.get(command)
+        if histogram is None:
+            histogram = self.command_latency[command] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        return {
+            'bytes_read': self.bytes_read,
+            'fragments_parsed': dict(self.fragments_parsed),
+            'unsupported_tags': dict(self.unsupported_tags),
+            'parse_seconds': self.parse_seconds.snapshot(),
+            'command_latency_seconds': {c: h.snapshot() for c, h in list(self.command_latency.items())}
+        }
+
+
+# Type, help text and label name for each value in the stats dict returned
+# by Emu.stats(). Values that are dicts are labelled by key.
+_PROMETHEUS = {
+    'bytes_read': ('counter', 'Bytes read from the device', None),
+    'fragments_parsed': ('counter', 'Fragments parsed, by tag', 'tag'),
+    'unsupported_tags': ('counter', 'Fragments with an unsupported tag', 'tag'),
+    'bytes_discarded': ('counter', 'Bytes discarded while recovering from malformed XML', None),
+    'fragments_discarded': ('counter', 'Fragments discarded as malformed', None),
+    'fragments_invalid': ('counter', 'Well formed fragments with values that could not be converted', None),
+    'command_timeouts': ('counter', 'Commands that timed out after all retries', None),
+    'command_retries': ('counter', 'Commands resent after a timeout', None),
+    'commands_in_flight': ('gauge', 'Commands waiting on a response', None),
+    'connected': ('gauge', 'Whether the serial port is open', None),
+    'reconnects': ('counter', 'Times the serial port was reopened after failing', None),
+    'subscription_queue_depth': ('gauge', 'Entities queued for subscribers', None),
+    'subscription_dropped': ('counter', 'Entities dropped by full subscriber queues', None),
+    'cache_hits': ('counter', 'Queries answered from the response cache', None),
+    'cache_misses': ('counter', 'Queries sent to the device on a cache miss', None),
+    'parse_seconds': ('histogram', 'Time to parse a fragment', None),
+    'command_latency_seconds': ('histogram', 'Command round trip time, by command', 'command')
+}
+
+
+# Render a stats dict in the Prometheus text exposition format
+def to_prometheus(stats, prefix='emu'):
+
+    lines = []
+    for key, value in stats.items():
+        spec = _PROMETHEUS.get(key)
+        if spec is None:
+            continue
+        metric_type, help_text, label = spec
+
+        name = prefix + '_' + key
+        if metric_type == 'counter' and not name.endswith('_total'):
+            name += '_total'
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        if metric_type == 'histogram':
+            histograms = value if label is not None else {None: value}
+            for label_value, histogram in histograms.items():
+                labels = '' if label is None else '{}="{}",'.format(label, label_value)
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, le, count))
+                labels = labels.rstrip(',')
+                labels = '{' + labels + '}' if labels else ''
+                lines.append('{}_sum{} {}'.format(name, labels, histogram['sum']))
+                lines.append('{}_count{} {}'.format(name, labels, histogram['count']))
+        elif label is not None:
+            for label_value, count in value.items():
+                lines.append('{}{{{}="{}"}} {}'.format(name, label, label_value, count))
+        else:
+            lines.append('{} {}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
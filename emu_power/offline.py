@@ -0,0 +1,178 @@
+import argparse
+import heapq
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from emu_power import response_entities
+from emu_power.parser import StreamParser
+from emu_power.sinks import TABLES, SQLiteSink, ParquetSink, table_columns
+
+# Bulk decoding of raw XML logs from the device, as written by a serial
+# logger, using every core. Each log is split into chunks on fragment
+# boundaries, the chunks are parsed in a process pool with the same parser
+# and entity classes used for live data, and the rows from every chunk are
+# merged back into timestamp order per table. Tables and columns are the
+# ones used by the sinks (see sinks.TABLES), with received_at left empty
+# since the time each fragment was received is not known.
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Split a log into (path, start, end) byte ranges of about chunk_size,
+# each starting on the opening line of a fragment
+def split_log(path, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    size = os.path.getsize(path)
+    openings = set(('<' + tag + '>').encode('ASCII') for tag in response_entities.Entity.registered_tags())
+
+    boundaries = [0]
+    with open(path, 'rb') as fh:
+        while boundaries[-1] + chunk_size < size:
+            fh.seek(boundaries[-1] + chunk_size)
+            fh.readline()
+            while True:
+                position = fh.tell()
+                line = fh.readline()
+                if not line or line.strip() in openings:
+                    break
+            if position >= size:
+                break
+            boundaries.append(position)
+
+    boundaries.append(size)
+    return [(path, start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+# Column index rows are ordered by for each table
+def _time_column(columns):
+    for i, (name, _, _) in enumerate(columns):
+        if name in ('timestamp', 'end_time'):
+            return i
+    return None
+
+
+def _sort_key(index):
+    if index is None:
+        return lambda row: 0
+    return lambda row: -1 if row[index] is None else row[index]
+
+
+# Parse one byte range of a log. Returns rows sorted by time keyed by tag,
+# and counters. Runs in a worker process.
+def decode_chunk(chunk):
+
+    path, start, end = chunk
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+
+    parser = StreamParser()
+    rows = {}
+    stats = {'fragments': 0, 'skipped': 0, 'invalid': 0}
+
+    # Make sure the last fragment is complete if the log ends mid line
+    for tree in parser.feed(data + b'\n'):
+        stats['fragments'] += 1
+        # Only entities with a table are decoded
+        klass = response_entities.Entity.tag_to_class(tree.tag)
+        table = TABLES.get(tree.tag)
+        if klass is None or table is None:
+            stats['skipped'] += 1
+            continue
+        try:
+            entity = klass(tree)
+            row = tuple(extract(entity) for _, _, extract in table[1]) + (None,)
+            rows.setdefault(tree.tag, []).append(row)
+        except (ValueError, TypeError):
+            stats['invalid'] += 1
+
+    for tag, tag_rows in rows.items():
+        tag_rows.sort(key=_sort_key(_time_column(TABLES[tag][1])))
+
+    stats['bytes_discarded'] = parser.bytes_discarded
+    stats['fragments_discarded'] = parser.fragments_discarded
+    return rows, stats
+
+
+# Decode a list of logs in a pool of processes (by default, one per core).
+# Returns an iterator over (tag, rows) for each table, with rows in
+# timestamp order, and a dict of counters.
+def decode_logs(paths, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    chunks = [chunk for path in paths for chunk in split_log(path, chunk_size)]
+
+    with ProcessPoolExecutor(processes) as executor:
+        results = list(executor.map(decode_chunk, chunks))
+
+    stats = {'chunks': len(chunks)}
+    for _, chunk_stats in results:
+        for key, value in chunk_stats.items():
+            stats[key] = stats.get(key, 0) + value
+
+    def tables():
+        for tag, (_, columns) in TABLES.items():
+            key = _sort_key(_time_column(columns))
+            chunk_rows = [rows[tag] for rows, _ in results if tag in rows]
+            if chunk_rows:
+                yield tag, heapq.merge(*chunk_rows, key=key)
+
+    return tables(), stats
+
+
+# Decode logs and write every table to the given sinks in batches
+def write_logs(paths, sinks, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, batch_size=10000):
+
+    tables, stats = decode_logs(paths, processes, chunk_size)
+    stats['rows'] = 0
+
+    for sink in sinks:
+        sink.open()
+    try:
+        for tag, rows in tables:
+            table = TABLES[tag][0]
+            columns = table_columns(tag)
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    for sink in sinks:
+                        sink.write(table, columns, batch)
+                    stats['rows'] += len(batch)
+                    batch = []
+            if batch:
+                for sink in sinks:
+                    sink.write(table, columns, batch)
+                stats['rows'] += len(batch)
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    return stats
+
+
+def main(args=None):
+
+    arg_parser = argparse.ArgumentParser(description="Decode raw EMU-2 XML logs into tables")
+    arg_parser.add_argument('logs', nargs='+', help="log files to decode")
+    arg_parser.add_argument('--sqlite', help="write tables to this SQLite database")
+    arg_parser.add_argument('--parquet', help="write tables as Parquet files in this directory")
+    arg_parser.add_argument('--processes', type=int, help="number of worker processes (default: one per core)")
+    arg_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="approximate bytes of log per work unit")
+    args = arg_parser.parse_args(args)
+
+    sinks = []
+    if args.sqlite:
+        sinks.append(SQLiteSink(args.sqlite))
+    if args.parquet:
+        sinks.append(ParquetSink(args.parquet))
+    if not sinks:
+        arg_parser.error("at least one of --sqlite or --parquet is required")
+
+    stats = write_logs(args.logs, sinks, args.processes, args.chunk_size)
+    for key, value in sorted(stats.items()):
+        print("{}: {}".format(key, value), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
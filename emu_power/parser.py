@@ -0,0 +1,192 @@
+import re
+from xml.etree import ElementTree
+from emu_power import response_entities
+
+# Bytes a single fragment may take up before it is treated as corrupt. The
+# largest the device sends are well under 2 KB.
+MAX_FRAGMENT_SIZE = 64 * 1024
+
+
+# Raised when a fragment starts with a tag that is not a known root
+class _UnexpectedRoot(Exception):
+    pass
+
+
+# Incremental parser for the stream of XML fragments sent by the device. Raw
+# bytes are fed in as they arrive from the serial port, and each top level
+# fragment (InstantaneousDemand, PriceCluster, ...) is returned as soon as its
+# closing tag has been seen, rather than waiting for a batch of lines.
+#
+# Corrupt data does not stop the stream. When the XML becomes malformed, a
+# known root tag shows up nested inside another fragment (meaning the previous
+# fragment was truncated), or a fragment starts with a tag that is not a known
+# root (meaning its opening tag was damaged), the parser skips ahead to the
+# next known root tag and carries on. So does a fragment that grows past
+# max_fragment_size bytes without closing, which keeps memory bounded. The
+# bytes and fragments lost this way are counted in bytes_discarded and
+# fragments_discarded.
+class StreamParser:
+
+    # Root tags default to those of all known response entities
+    def __init__(self, root_tags=None, max_fragment_size=MAX_FRAGMENT_SIZE):
+
+        if root_tags is None:
+            root_tags = response_entities.Entity.registered_tags()
+
+        self._root_tags = set(root_tags)
+        self.max_fragment_size = max_fragment_size
+        alternatives = b'|'.join(re.escape(tag.encode('ASCII')) for tag in sorted(self._root_tags))
+        self._root_pattern = re.compile(b'<(?:' + alternatives + b')[\\s/>]')
+
+        self.bytes_discarded = 0
+        self.fragments_discarded = 0
+
+        self._parser = None
+        self._root = None
+        self._depth = 0
+        self._pending = bytearray()
+        self._skipping = False
+        self.reset()
+
+    # Discard any partially parsed data and start over with a clean parser.
+    # The device sends a sequence of sibling fragments with no document root,
+    # so we open a pseudo root that is never closed.
+    def reset(self):
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._parser.feed(b'<Root>')
+        self._root = None
+        self._depth = 0
+        self._pending = bytearray()
+
+    # Feed raw bytes into the parser, returning a list of any fragments that
+    # were completed by this data.
+    def feed(self, data):
+
+        data = bytes(data)
+        fragments = []
+
+        # Data is fed a line at a time. The device puts each tag on its own
+        # line, so this lets us keep track of the raw bytes belonging to the
+        # fragment currently being parsed, which is where we need to resume
+        # from if it turns out to be corrupt.
+        start = 0
+        while start < len(data):
+
+            end = data.find(b'\n', start) + 1 or len(data)
+            line = data[start:end]
+
+            closed = []
+            unexpected = False
+            oversized = False
+            try:
+                self._parser.feed(line)
+                nested = self._read_events(fragments, closed)
+            except ElementTree.ParseError:
+                nested = None
+            except _UnexpectedRoot:
+                nested = None
+                unexpected = True
+            else:
+                if nested is None:
+                    # Only bytes of the fragment still open need keeping
+                    if closed:
+                        line = self._after_close(bytes(self._pending) + line, closed[-1])
+                        self._pending.clear()
+                    if self._depth > 1 or not line.endswith(b'\n'):
+                        if len(self._pending) + len(line) <= self.max_fragment_size:
+                            self._pending.extend(line)
+                            start = end
+                            continue
+                        oversized = True
+                    else:
+                        self._pending.clear()
+                        start = end
+                        continue
+
+            # Something went wrong - find a place to restart from
+            buf = bytes(self._pending) + data[start:]
+            limit = len(self._pending) + len(line)
+            if nested is not None:
+                pos = buf.rfind(b'<' + nested.encode('ASCII'), 0, limit)
+            if nested is None or pos <= 0:
+                pos = self._resync_position(buf, len(self._pending), closed)
+
+            # Count each fragment once, however many of its children are
+            # skipped on the way to the next root, including one with a
+            # damaged opening tag or that is too large
+            discarded = len(self._root_pattern.findall(buf, 0, pos))
+            if (unexpected or oversized) and not self._skipping:
+                discarded = max(discarded, 1)
+            if discarded:
+                self._skipping = True
+            self.bytes_discarded += pos
+            self.fragments_discarded += discarded
+
+            self.reset()
+            data = buf[pos:]
+            start = 0
+
+        return fragments
+
+    # Collect completed fragments from the pull parser. Returns the tag of a
+    # known root element found nested inside another fragment, if any, in
+    # which case the remaining events are abandoned.
+    def _read_events(self, fragments, closed):
+
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = elem
+                elif self._depth == 1:
+                    if elem.tag not in self._root_tags:
+                        raise _UnexpectedRoot()
+                    self._skipping = False
+                elif self._depth > 1 and elem.tag in self._root_tags:
+                    return elem.tag
+                self._depth += 1
+            else:
+                self._depth -= 1
+
+                # Only direct children of the pseudo root are fragments. Drop
+                # them from the root once complete so memory stays flat.
+                if self._depth == 1:
+                    fragments.append(elem)
+                    closed.append(elem.tag)
+                    self._root.remove(elem)
+
+        return None
+
+    # The part of the data after the closing tag of the last fragment it
+    # completed. The closing tag may have started in an earlier feed, so
+    # this is given the pending bytes as well as the line.
+    def _after_close(self, line, tag):
+        close_tag = b'</' + tag.encode('ASCII') + b'>'
+        found = line.rfind(close_tag)
+        if found >= 0:
+            return line[found + len(close_tag):]
+        found = line.rfind(b'/>')
+        return line[found + 2:] if found >= 0 else line
+
+    # Find where to restart after a parse error in buf. Fragments that were
+    # already completed before the error are skipped so they are not
+    # returned twice. Always makes progress, so a bad byte cannot wedge us.
+    def _resync_position(self, buf, line_start, closed):
+
+        search_from = 1
+        for tag in closed:
+            close_tag = b'</' + tag.encode('ASCII') + b'>'
+            found = buf.find(close_tag, max(search_from, line_start))
+            if found >= 0:
+                search_from = found + len(close_tag)
+
+        match = self._root_pattern.search(buf, search_from)
+        if match is not None:
+            return match.start()
+
+        # No root tag yet, but the end of the buffer may hold the start of
+        # one that has not fully arrived
+        last = buf.rfind(b'<', search_from)
+        if last > 0 and buf.find(b'>', last) < 0:
+            return last
+
+        return len(buf)
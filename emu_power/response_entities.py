@@ -1,22 +1,147 @@
-from xml.etree import ElementTree
+from array import array
 
+# Timestamps from the device count seconds from 2000-01-01 00:00:00 UTC
+# rather than the Unix epoch. This is the offset between the two.
+RAINFOREST_EPOCH = 946684800
 
-# Base class for a response entity. All individual response
-# objects inherit from this.
-class Entity:
 
-    def __init__(self, tree):
+# Convert a hex Rainforest timestamp into seconds since the Unix epoch.
+# Returns None if the timestamp is missing.
+def rainforest_to_unix(text):
+    if text is None:
+        return None
+    return int(text, 16) + RAINFOREST_EPOCH
+
+
+# Convert seconds since the Unix epoch into a Rainforest timestamp
+def unix_to_rainforest(unix_time):
+    return int(unix_time) - RAINFOREST_EPOCH
+
+
+# Key for the most recent entity of a response type from a single meter.
+# MACs are compared ignoring case.
+def meter_key(tag, meter_mac):
+    return tag, None if meter_mac is None else meter_mac.lower()
+
+
+# Compute a price from its hex value and number of trailing digits
+def scale_price(price, trailing_digits):
+    return int(price, 16) / 10.0 ** int(trailing_digits or '0x00', 16)
+
+
+# Compute the actual value of a metering reading from its raw value and
+# scaling factors (protecting from divide-by-zero)
+def scale_reading(value, multiplier, divisor):
+    if divisor != 0:
+        return value * multiplier / float(divisor)
+    return 0
+
+
+# Converters for field values. Each takes the text of an element, or None
+# if the element is missing, and returns the value stored on the entity.
+
+def as_text(text):
+    return text
+
+
+def as_hex(text):
+    return int(text or "0x00", 16)
+
+
+def as_yn(text):
+    if text is None:
+        return None
+    return text == 'Y'
+
+
+def as_timestamp(text):
+    return rainforest_to_unix(text)
+
+
+# Root tag to entity class, filled in as each class is defined
+_registry = {}
+
+
+# Metaclass for entities. Turns the declared fields of each class into
+# slots, builds the lookup table used to parse them, and registers the
+# class against its root tag.
+class _EntityMeta(type):
+
+    def __new__(mcs, name, bases, namespace):
+
+        fields = namespace.get('fields', ())
+        namespace['__slots__'] = tuple(f[0] for f in fields) + tuple(namespace.get('__slots__', ()))
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        # Inherited fields are parsed too, with subclasses able to override
+        # the handling of a tag
+        field_map = {}
+        for klass in reversed(cls.__mro__):
+            for field_name, tag, converter in klass.__dict__.get('fields', ()):
+                field_map[tag] = (field_name, converter)
+
+        cls._field_map = field_map
+        cls._field_defaults = {f: c(None) for f, c in field_map.values()}
 
-        self._tree = tree
-        self.fresh = True
+        if any(isinstance(base, _EntityMeta) for base in bases):
+            _registry[cls.tag_name()] = cls
 
-        # These tags are common to all responses
-        self.device_mac = self.find_text('DeviceMacId')
+        return cls
 
+
+# Base class for a response entity. All individual response
+# objects inherit from this. Entities declare their fields as
+# (attribute name, XML tag, converter) tuples, which are filled
+# in with a single pass over the children of the root element.
+# Subclasses may override _parse to compute further values.
+#
+# Entities are slotted, and only hold on to the XML tree while
+# parsing, so that large numbers of them can be kept in memory
+# cheaply. Pass frozen=True to make the parsed fields read only;
+# the fresh flag may still be updated.
+class Entity(metaclass=_EntityMeta):
+
+    __slots__ = ('_tree', '_frozen', 'fresh')
+
+    # These tags are common to all responses
+    fields = (
+        ('device_mac', 'DeviceMacId', as_text),
+    )
+
+    def __init__(self, tree, frozen=False):
+
+        init = object.__setattr__
+        init(self, '_frozen', False)
+        init(self, 'fresh', True)
+
+        # Walk the children backwards so that if a tag is repeated, the
+        # first occurrence wins. Missing fields get the converted value of
+        # None, e.g. 0 for hex fields.
+        values = dict(self._field_defaults)
+        field_map = self._field_map
+        for child in reversed(tree):
+            field = field_map.get(child.tag)
+            if field is not None:
+                values[field[0]] = field[1](child.text)
+
+        for name, value in values.items():
+            init(self, name, value)
+
+        init(self, '_tree', tree)
         self._parse()
+        init(self, '_tree', None)
+        init(self, '_frozen', frozen)
+
+    def __setattr__(self, name, value):
+        if self._frozen and name != 'fresh':
+            raise AttributeError(type(self).__name__ + " is frozen")
+        object.__setattr__(self, name, value)
 
     def __repr__(self):
-        return ElementTree.tostring(self._tree).decode('ASCII')
+        fields = ", ".join(
+            "{}={!r}".format(name, getattr(self, name, None)) for name in self.field_names()
+        )
+        return "{}({})".format(type(self).__name__, fields)
 
     # Hook for subclasses to override to provide special parsing
     # for computing their parameters.
@@ -32,6 +157,16 @@ class Entity:
     def find_hex(self, text):
         return int(self.find_text(text) or "0x00", 16)
 
+    # Names of the public fields of this class, in declaration order
+    @classmethod
+    def field_names(cls):
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in getattr(klass, '__slots__', ()):
+                if not name.startswith('_') and name != 'fresh':
+                    names.append(name)
+        return names
+
     # The root element associated with this class
     @classmethod
     def tag_name(cls):
@@ -40,10 +175,12 @@ class Entity:
     # Map the tag name to the type of subclass
     @classmethod
     def tag_to_class(cls, tag):
-        for klass in cls.__subclasses__():
-            if klass.tag_name() == tag:
-                return klass
-        return None
+        return _registry.get(tag)
+
+    # Root tags of all known entity classes
+    @classmethod
+    def registered_tags(cls):
+        return list(_registry)
 
 
 #####################################
@@ -51,41 +188,52 @@ class Entity:
 #####################################
 
 class ConnectionStatus(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text('MeterMacId')
-        self.status = self.find_text("Status")
-        self.description = self.find_text("Description")
-        self.status_code = self.find_text("StatusCode")         # 0x00 to 0xFF
-        self.extended_pan_id = self.find_text("ExtPanId")
-        self.channel = self.find_text("Channel")                # 11 to 26
-        self.short_address = self.find_text("ShortAddr")        # 0x0000 to 0xFFFF
-        self.link_strength = self.find_text("LinkStrength")     # 0x00 to 0x64
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('status', 'Status', as_text),
+        ('description', 'Description', as_text),
+        ('status_code', 'StatusCode', as_text),             # 0x00 to 0xFF
+        ('extended_pan_id', 'ExtPanId', as_text),
+        ('channel', 'Channel', as_text),                    # 11 to 26
+        ('short_address', 'ShortAddr', as_text),            # 0x0000 to 0xFFFF
+        ('link_strength', 'LinkStrength', as_text),         # 0x00 to 0x64
+    )
 
 
 class DeviceInfo(Entity):
-    def _parse(self):
-        self.install_code = self.find_text("InstallCode")
-        self.link_key = self.find_text("LinkKey")
-        self.fw_version = self.find_text("FWVersion")
-        self.hw_version = self.find_text("HWVersion")
-        self.fw_image_type = self.find_text("ImageType")
-        self.manufacturer = self.find_text("Manufacturer")
-        self.model_id = self.find_text("ModelId")
-        self.date_code = self.find_text("DateCode")
+    fields = (
+        ('install_code', 'InstallCode', as_text),
+        ('link_key', 'LinkKey', as_text),
+        ('fw_version', 'FWVersion', as_text),
+        ('hw_version', 'HWVersion', as_text),
+        ('fw_image_type', 'ImageType', as_text),
+        ('manufacturer', 'Manufacturer', as_text),
+        ('model_id', 'ModelId', as_text),
+        ('date_code', 'DateCode', as_text),
+    )
 
 
 class ScheduleInfo(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.event = self.find_text("Event")
-        self.frequency = self.find_text("Frequency")
-        self.enabled = self.find_text("Enabled")
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('event', 'Event', as_text),
+        ('frequency', 'Frequency', as_text),
+        ('enabled', 'Enabled', as_text),
+    )
 
 
-# TODO: There can be more than one MeterMacId
+# Lists every meter the device is joined to, in meter_macs. The first is
+# also in meter_mac.
 class MeterList(Entity):
+
+    __slots__ = ('meter_macs',)
+
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+    )
+
     def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
+        self.meter_macs = tuple(child.text for child in self._tree if child.tag == 'MeterMacId')
 
 
 #####################################
@@ -93,26 +241,28 @@ class MeterList(Entity):
 #####################################
 
 class MeterInfo(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.meter_type = self.find_text("MeterType")
-        self.nickname = self.find_text("NickName")
-        self.account = self.find_text("Account")
-        self.auth = self.find_text("Auth")
-        self.host = self.find_text("Host")
-        self.enabled = self.find_text("Enabled")
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('meter_type', 'MeterType', as_text),
+        ('nickname', 'NickName', as_text),
+        ('account', 'Account', as_text),
+        ('auth', 'Auth', as_text),
+        ('host', 'Host', as_text),
+        ('enabled', 'Enabled', as_text),
+    )
 
 
 class NetworkInfo(Entity):
-    def _parse(self):
-        self.coordinator_mac = self.find_text("CoordMacId")
-        self.status = self.find_text("Status")
-        self.description = self.find_text("Description")
-        self.status_code = self.find_text("StatusCode")
-        self.extended_pan_id = self.find_text("ExtPanId")
-        self.channel = self.find_text("Channel")
-        self.short_address = self.find_text("ShortAddr")
-        self.link_strength = self.find_text("LinkStrength")
+    fields = (
+        ('coordinator_mac', 'CoordMacId', as_text),
+        ('status', 'Status', as_text),
+        ('description', 'Description', as_text),
+        ('status_code', 'StatusCode', as_text),
+        ('extended_pan_id', 'ExtPanId', as_text),
+        ('channel', 'Channel', as_text),
+        ('short_address', 'ShortAddr', as_text),
+        ('link_strength', 'LinkStrength', as_text),
+    )
 
 
 #####################################
@@ -121,10 +271,11 @@ class NetworkInfo(Entity):
 
 # TODO: Convert from Rainforest epoch
 class TimeCluster(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.utc_time = self.find_text("UTCTime")
-        self.local_time = self.find_text("LocalTime")
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('utc_time', 'UTCTime', as_text),
+        ('local_time', 'LocalTime', as_text),
+    )
 
 
 #####################################
@@ -132,14 +283,15 @@ class TimeCluster(Entity):
 #####################################
 
 class MessageCluster(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.timestamp = self.find_text("TimeStamp")
-        self.id = self.find_text("Id")
-        self.text = self.find_text("Text")
-        self.confirmation_required = self.find_text("ConfirmationRequired")
-        self.confirmed = self.find_text("Confirmed")
-        self.queue = self.find_text("Queue")
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('timestamp', 'TimeStamp', as_text),
+        ('id', 'Id', as_text),
+        ('text', 'Text', as_text),
+        ('confirmation_required', 'ConfirmationRequired', as_text),
+        ('confirmed', 'Confirmed', as_text),
+        ('queue', 'Queue', as_text),
+    )
 
 
 #####################################
@@ -147,15 +299,16 @@ class MessageCluster(Entity):
 #####################################
 
 class PriceCluster(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.timestamp = self.find_text("TimeStamp")
-        self.price = self.find_text("Price")
-        self.currency = self.find_text("Currency")      # ISO-4217
-        self.trailing_digits = self.find_text("TrailingDigits")
-        self.tier = self.find_text("Tier")
-        self.tier_label = self.find_text("TierLabel")
-        self.rate_label = self.find_text("RateLabel")
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('timestamp', 'TimeStamp', as_text),
+        ('price', 'Price', as_text),
+        ('currency', 'Currency', as_text),                  # ISO-4217
+        ('trailing_digits', 'TrailingDigits', as_text),
+        ('tier', 'Tier', as_text),
+        ('tier_label', 'TierLabel', as_text),
+        ('rate_label', 'RateLabel', as_text),
+    )
 
 
 #####################################
@@ -163,80 +316,124 @@ class PriceCluster(Entity):
 #####################################
 
 class InstantaneousDemand(Entity):
+    __slots__ = ('reading',)
+
+    # Tag holding the raw value that reading is computed from
+    reading_tag = 'Demand'
+
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('timestamp', 'TimeStamp', as_text),
+        ('demand', 'Demand', as_hex),
+        ('multiplier', 'Multiplier', as_hex),
+        ('divisor', 'Divisor', as_hex),
+        ('digits_right', 'DigitsRight', as_hex),
+        ('digits_left', 'DigitsLeft', as_hex),
+        ('suppress_leading_zero', 'SuppressLeadingZero', as_text),
+    )
+
     def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.timestamp = self.find_text("TimeStamp")
-        self.demand = self.find_hex("Demand")
-        self.multiplier = self.find_hex("Multiplier")
-        self.divisor = self.find_hex("Divisor")
-        self.digits_right = self.find_hex("DigitsRight")
-        self.digits_left = self.find_hex("DigitsLeft")
-        self.suppress_leading_zero = self.find_text("SuppressLeadingZero")
-
-        # Compute actual reading (protecting from divide-by-zero)
-        if self.divisor != 0:
-            self.reading = self.demand * self.multiplier / float(self.divisor)
-        else:
-            self.reading = 0
+        self.reading = scale_reading(self.demand, self.multiplier, self.divisor)
 
 
 class CurrentSummationDelivered(Entity):
+    __slots__ = ('reading',)
+
+    # Tag holding the raw value that reading is computed from
+    reading_tag = 'SummationDelivered'
+
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('timestamp', 'TimeStamp', as_text),
+        ('summation_delivered', 'SummationDelivered', as_hex),
+        ('summation_received', 'SummationReceived', as_hex),
+        ('multiplier', 'Multiplier', as_hex),
+        ('divisor', 'Divisor', as_hex),
+        ('digits_right', 'DigitsRight', as_hex),
+        ('digits_left', 'DigitsLeft', as_hex),
+        ('suppress_leading_zero', 'SuppressLeadingZero', as_text),
+    )
+
     def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.timestamp = self.find_text("TimeStamp")
-        self.summation_delivered = self.find_hex("SummationDelivered")
-        self.summation_received = self.find_hex("SummationReceived")
-        self.multiplier = self.find_hex("Multiplier")
-        self.divisor = self.find_hex("Divisor")
-        self.digits_right = self.find_hex("DigitsRight")
-        self.digits_left = self.find_hex("DigitsLeft")
-        self.suppress_leading_zero = self.find_text("SuppressLeadingZero")
-
-        # Compute actual reading (protecting from divide-by-zero)
-        if self.divisor != 0:
-            self.reading = self.summation_delivered * self.multiplier / float(self.divisor)
-        else:
-            self.reading = 0
+        self.reading = scale_reading(self.summation_delivered, self.multiplier, self.divisor)
 
 
 class CurrentPeriodUsage(Entity):
+    __slots__ = ('reading',)
+
+    # Tag holding the raw value that reading is computed from
+    reading_tag = 'CurrentUsage'
+
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('timestamp', 'TimeStamp', as_text),
+        ('current_usage', 'CurrentUsage', as_hex),
+        ('multiplier', 'Multiplier', as_hex),
+        ('divisor', 'Divisor', as_hex),
+        ('digits_right', 'DigitsRight', as_hex),
+        ('digits_left', 'DigitsLeft', as_hex),
+        ('suppress_leading_zero', 'SuppressLeadingZero', as_text),
+        ('start_date', 'StartDate', as_text),
+    )
+
     def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.timestamp = self.find_text("TimeStamp")
-        self.current_usage = self.find_hex("CurrentUsage")
-        self.multiplier = self.find_hex("Multiplier")
-        self.divisor = self.find_hex("Divisor")
-        self.digits_right = self.find_hex("DigitsRight")
-        self.digits_left = self.find_hex("DigitsLeft")
-        self.suppress_leading_zero = self.find_text("SuppressLeadingZero")
-        self.start_date = self.find_text("StartDate")
-
-        # Compute actual reading (protecting from divide-by-zero)
-        if self.divisor != 0:
-            self.reading = self.current_usage * self.multiplier / float(self.divisor)
-        else:
-            self.reading = 0
+        self.reading = scale_reading(self.current_usage, self.multiplier, self.divisor)
 
 
 class LastPeriodUsage(Entity):
-    def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.last_usage = self.find_hex("LastUsage")
-        self.multiplier = self.find_hex("Multiplier")
-        self.divisor = self.find_hex("Divisor")
-        self.digits_right = self.find_hex("DigitsRight")
-        self.digits_left = self.find_hex("DigitsLeft")
-        self.suppress_leading_zero = self.find_text("SuppressLeadingZero")
-        self.start_date = self.find_text("StartDate")
-        self.end_date = self.find_text("EndDate")
-
-
-# TODO: IntervalData may appear more than once
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('last_usage', 'LastUsage', as_hex),
+        ('multiplier', 'Multiplier', as_hex),
+        ('divisor', 'Divisor', as_hex),
+        ('digits_right', 'DigitsRight', as_hex),
+        ('digits_left', 'DigitsLeft', as_hex),
+        ('suppress_leading_zero', 'SuppressLeadingZero', as_text),
+        ('start_date', 'StartDate', as_text),
+        ('end_date', 'EndDate', as_text),
+    )
+
+
+# Length in seconds of each ProfileIntervalPeriod
+PROFILE_INTERVALS = {0: 86400, 1: 3600, 2: 1800, 3: 900, 4: 600, 5: 450, 6: 300, 7: 150}
+
+# Interval value the meter uses for an interval it has no data for
+PROFILE_INVALID = 0xFFFFFF
+
+
+# The device sends one IntervalData element per interval, most recent
+# first. They are all collected into interval_data, an array of raw values
+# oldest first, with intervals the meter has no data for as NaN. The raw
+# values use the same units as CurrentSummationDelivered before scaling.
 class ProfileData(Entity):
+
+    __slots__ = ('interval_data', 'interval_seconds')
+
+    fields = (
+        ('meter_mac', 'MeterMacId', as_text),
+        ('end_time', 'EndTime', as_text),
+        ('status', 'Status', as_text),
+        ('period_interval', 'ProfileIntervalPeriod', as_text),
+        ('number_of_periods', 'NumberOfPeriodsDelivered', as_text),
+    )
+
     def _parse(self):
-        self.meter_mac = self.find_text("MeterMacId")
-        self.end_time = self.find_text("EndTime")
-        self.status = self.find_text("Status")
-        self.period_interval = self.find_text("ProfileIntervalPeriod")
-        self.number_of_periods = self.find_text("NumberOfPeriodsDelivered")
-        self.interval_data = self.find_text("IntervalData")
+
+        values = array('d')
+        for child in self._tree:
+            if child.tag.startswith('IntervalData'):
+                value = int(child.text or '0xffffff', 16)
+                values.append(float('nan') if value == PROFILE_INVALID else value)
+        values.reverse()
+
+        self.interval_data = values
+        self.interval_seconds = PROFILE_INTERVALS.get(as_hex(self.period_interval))
+
+    # Unix time at the end of each interval in interval_data, or None if
+    # the end time or interval period is missing
+    def interval_times(self):
+        end = rainforest_to_unix(self.end_time)
+        if end is None or self.interval_seconds is None:
+            return None
+        count = len(self.interval_data)
+        return array('d', (end - (count - 1 - i) * self.interval_seconds for i in range(count)))
@@ -0,0 +1,194 @@
+import heapq
+import threading
+import time
+from concurrent.futures import Future
+from emu_power.commands import Commands
+
+
+# Tracks commands that are waiting on a response, so that several can be in
+# flight at once. Each command gets a Future which is resolved by the first
+# matching response to arrive, or with None if it times out. Responses are
+# matched on root tag, and also on MeterMacId when the command named a meter,
+# with the oldest outstanding command matched first, so two callers waiting
+# on the same type of response each get their own. Commands that time out
+# can be sent again a number of times before giving up.
+class CommandScheduler:
+
+    # Write is the function used to send data to the device. If set,
+    # on_response is called with the command name and round trip time in
+    # seconds whenever a command gets its response.
+    def __init__(self, write, on_response=None):
+
+        self._write = write
+        self.on_response = on_response
+
+        # Outstanding commands in the order sent, keyed by response tag
+        self._pending = {}
+
+        # Heap of (deadline, sequence, command) for the timeout thread. Entries
+        # for commands that have since completed are skipped when popped.
+        self._deadlines = []
+        self._sequence = 0
+
+        self._condition = threading.Condition()
+        self._thread_handle = None
+
+        self.timeouts = 0
+        self.retries = 0
+
+    # Number of commands waiting on a response
+    def in_flight(self):
+        with self._condition:
+            return sum(len(p) for p in self._pending.values())
+
+    # Send a command and return a Future for its response. The command is
+    # registered before it is written, so a fast response cannot be missed.
+    def submit(self, data, return_class, meter_mac=None, timeout=10, retries=0, name=None):
+
+        command = _PendingCommand(name, data, return_class.tag_name(), meter_mac, timeout, retries)
+
+        with self._condition:
+            self._pending.setdefault(command.tag, []).append(command)
+            self._schedule(command)
+            if self._thread_handle is None:
+                self._thread_handle = threading.Thread(target=self._timeout_thread, daemon=True)
+                self._thread_handle.start()
+            self._condition.notify()
+
+        try:
+            self._write(data)
+        except Exception:
+            self._finish(command, None)
+            raise
+
+        return command.future
+
+    # Resolve the oldest outstanding command matching an entity. Returns
+    # whether there was one.
+    def resolve(self, entity):
+
+        meter_mac = _normalize_mac(getattr(entity, 'meter_mac', None))
+        with self._condition:
+            commands = self._pending.get(entity.tag_name())
+            if not commands:
+                return False
+            for command in commands:
+                if command.meter_mac is None or meter_mac is None or command.meter_mac == meter_mac:
+                    break
+            else:
+                return False
+
+        self._finish(command, entity)
+        return True
+
+    # Give up on everything outstanding, resolving it all with None
+    def cancel_all(self):
+        with self._condition:
+            commands = [c for p in self._pending.values() for c in p]
+        for command in commands:
+            self._finish(command, None)
+
+    # Never raises, since it runs on the reader and timeout threads. The
+    # caller may have cancelled the Future, in which case the result is
+    # dropped.
+    def _finish(self, command, result):
+        with self._condition:
+            if command.done:
+                return
+            command.done = True
+            self._pending[command.tag].remove(command)
+            self._condition.notify()
+
+        if result is not None and self.on_response is not None:
+            try:
+                self.on_response(command.name, time.time() - command.sent)
+            except Exception:
+                pass
+        if command.future.set_running_or_notify_cancel():
+            command.future.set_result(result)
+
+    # Must be called with the condition held
+    def _schedule(self, command):
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (time.time() + command.timeout, self._sequence, command))
+
+    # Handles timeouts and retries for every outstanding command, sleeping
+    # until the next deadline. Exits once nothing is outstanding, to be
+    # started again by the next submit.
+    def _timeout_thread(self):
+        while True:
+
+            expired = []
+            resend = []
+            with self._condition:
+                if not any(self._pending.values()):
+                    self._deadlines = []
+                    self._thread_handle = None
+                    return
+
+                now = time.time()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, _, command = heapq.heappop(self._deadlines)
+                    if command.done:
+                        continue
+                    if command.retries_left > 0:
+                        command.retries_left -= 1
+                        command.sent = now
+                        self.retries += 1
+                        self._schedule(command)
+                        resend.append(command)
+                    else:
+                        self.timeouts += 1
+                        expired.append(command)
+
+                if not expired and not resend:
+                    timeout = self._deadlines[0][0] - now if self._deadlines else None
+                    self._condition.wait(timeout)
+                    continue
+
+            for command in expired:
+                self._finish(command, None)
+
+            # A failed write ends that command, not the thread
+            for command in resend:
+                try:
+                    self._write(command.data)
+                except Exception:
+                    self._finish(command, None)
+
+
+class _PendingCommand:
+
+    def __init__(self, name, data, tag, meter_mac, timeout, retries):
+        self.name = name
+        self.sent = time.time()
+        self.data = data
+        self.tag = tag
+        self.meter_mac = _normalize_mac(meter_mac)
+        self.timeout = timeout
+        self.retries_left = retries
+        self.done = False
+        self.future = Future()
+
+
+def _normalize_mac(mac):
+    return None if mac is None else mac.lower()
+
+
+# Issues commands without waiting for each response before sending the
+# next. Every command method returns a Future that resolves to the response
+# entity, or None on timeout (commands without a response resolve to True
+# once sent). For example, to refresh several values in one round trip:
+#
+#   pipeline = api.pipeline()
+#   futures = [pipeline.get_device_info(), pipeline.get_network_info()]
+#   device_info, network_info = [f.result() for f in futures]
+class Pipeline(Commands):
+
+    def __init__(self, emu, timeout=None, retries=None):
+        self._emu = emu
+        self.timeout = timeout
+        self.retries = retries
+
+    def issue_command(self, command, params=None, return_class=None):
+        return self._emu.submit_command(command, params, return_class, self.timeout, self.retries)
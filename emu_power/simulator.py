@@ -0,0 +1,382 @@
+import heapq
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+from emu_power import response_entities
+from emu_power.parser import StreamParser
+
+# Events accepted by set_schedule, and the notification each one produces
+SCHEDULE_EVENTS = {
+    'time': 'TimeCluster',
+    'summation': 'CurrentSummationDelivered',
+    'message': 'MessageCluster',
+    'price': 'PriceCluster',
+    'demand': 'InstantaneousDemand'
+}
+
+
+# Simulated EMU-2 for testing and benchmarking without hardware. The device
+# is presented on a pseudo terminal, so Emu talks to it through the real
+# serial code path:
+#
+#   sim = EmuSimulator(seed=1)
+#   api.start_serial(sim.start())
+#
+# Every command sent by Emu is answered with a realistic response, and
+# notifications can be pushed on a schedule, either configured up front with
+# schedule() or by the client with set_schedule and set_fast_poll. To exercise
+# the client, responses can be delayed by a random jitter, written out in
+# random small pieces, and corrupted with a given probability. Passing a seed
+# makes all of this reproducible. Requires a POSIX platform.
+class EmuSimulator:
+
+    def __init__(self, seed=None, jitter=0.0, fragment_size=0, fragment_delay=0.0,
+                 corrupt_probability=0.0, demand=1.5):
+
+        self.jitter = jitter
+        self.fragment_size = fragment_size
+        self.fragment_delay = fragment_delay
+        self.corrupt_probability = corrupt_probability
+
+        self.device_mac = '0xd8d5b90000001234'
+        self.meter_mac = '0x00135001002f3c4d'
+
+        # Meter state. Demand wanders around the given value in kW, and the
+        # summation integrates it.
+        self.base_demand = demand
+        self.demand = demand
+        self.summation = 10000.0
+        self.period_start = time.time()
+        self.period_start_summation = self.summation
+        self.price = 1234
+        self.price_digits = 4
+        self.profile_days = 30
+
+        # Counters
+        self.commands_received = 0
+        self.fragments_sent = 0
+        self.fragments_corrupted = 0
+
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave = None
+        self._thread_handle = None
+        self._stop_thread = False
+        self._lock = threading.Lock()
+        self._last_update = time.time()
+
+        # Notification intervals in seconds keyed by tag, and when each is
+        # next due
+        self._intervals = {}
+        self._next_due = {}
+        self._fast_poll_until = 0
+        self._fast_poll_interval = None
+
+        # Pending writes as (due time, sequence, data), so delayed responses
+        # still go out in order
+        self._outbox = []
+        self._sequence = 0
+
+    # Push the notification for a response class (or its tag) every interval
+    # seconds. An interval of None stops it.
+    def schedule(self, klass, interval):
+        tag = klass if isinstance(klass, str) else klass.tag_name()
+        with self._lock:
+            if interval is None:
+                self._intervals.pop(tag, None)
+                self._next_due.pop(tag, None)
+            else:
+                self._intervals[tag] = interval
+                self._next_due[tag] = time.time() + interval
+
+    # Start the simulated device, returning the name of the port to open
+    def start(self):
+
+        if self._thread_handle is not None:
+            return os.ttyname(self._slave)
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+
+        self._stop_thread = False
+        self._thread_handle = threading.Thread(target=self._device_thread, daemon=True)
+        self._thread_handle.start()
+        return os.ttyname(self._slave)
+
+    def stop(self):
+
+        if self._thread_handle is None:
+            return
+
+        self._stop_thread = True
+        self._thread_handle.join()
+        self._thread_handle = None
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = None
+        self._slave = None
+
+    # Handle a command the way the device would, returning the XML of the
+    # response, or None if it does not have one
+    def respond(self, command):
+
+        name = command.findtext('Name')
+        self.commands_received += 1
+        self._update_meter()
+
+        if name == 'set_schedule':
+            event = SCHEDULE_EVENTS.get(command.findtext('Event'))
+            if event is not None:
+                enabled = command.findtext('Enabled') != 'N'
+                frequency = int(command.findtext('Frequency') or '0x0a', 16)
+                self.schedule(event, frequency if enabled else None)
+            return None
+
+        if name == 'set_fast_poll':
+            frequency = max(int(command.findtext('Frequency') or '0x04', 16), 1)
+            duration = int(command.findtext('Duration') or '0x14', 16)
+            with self._lock:
+                self._fast_poll_interval = frequency
+                self._fast_poll_until = time.time() + duration * 60
+                self._next_due['InstantaneousDemand'] = time.time() + frequency
+            return None
+
+        if name == 'set_current_price':
+            self.price = int(command.findtext('Price') or '0x0', 16)
+            self.price_digits = int(command.findtext('TrailingDigits') or '0x00', 16)
+            return None
+
+        if name == 'close_current_period':
+            self.period_start = time.time()
+            self.period_start_summation = self.summation
+            return None
+
+        if name == 'get_profile_data':
+            return self._profile_data(command)
+
+        if name == 'get_schedule':
+            event = command.findtext('Event') or 'demand'
+            interval = self._intervals.get(SCHEDULE_EVENTS.get(event))
+            return self._fragment('ScheduleInfo', [
+                ('MeterMacId', self.meter_mac),
+                ('Event', event),
+                ('Frequency', '0x{:08x}'.format(interval or 0)),
+                ('Enabled', 'Y' if interval is not None else 'N')
+            ])
+
+        tag = _COMMAND_RESPONSES.get(name)
+        if tag is None:
+            return None
+        return self.notification(tag)
+
+    # Build the XML for a notification of the given tag from the current state
+    def notification(self, tag):
+
+        now = self._device_time()
+        if tag == 'InstantaneousDemand':
+            fields = [('MeterMacId', self.meter_mac), ('TimeStamp', now),
+                      ('Demand', '0x{:06x}'.format(int(self.demand * 1000)))] + self._formatting()
+        elif tag == 'CurrentSummationDelivered':
+            fields = [('MeterMacId', self.meter_mac), ('TimeStamp', now),
+                      ('SummationDelivered', '0x{:016x}'.format(int(self.summation * 1000))),
+                      ('SummationReceived', '0x0000000000000000')] + self._formatting()
+        elif tag == 'CurrentPeriodUsage':
+            usage = self.summation - self.period_start_summation
+            fields = [('MeterMacId', self.meter_mac), ('TimeStamp', now),
+                      ('CurrentUsage', '0x{:012x}'.format(int(usage * 1000)))] + self._formatting() + [
+                      ('StartDate', self._device_time(self.period_start))]
+        elif tag == 'LastPeriodUsage':
+            fields = [('MeterMacId', self.meter_mac), ('LastUsage', '0x{:012x}'.format(0))] + \
+                self._formatting() + [('StartDate', now), ('EndDate', now)]
+        elif tag == 'PriceCluster':
+            fields = [('MeterMacId', self.meter_mac), ('TimeStamp', now),
+                      ('Price', '0x{:08x}'.format(self.price)), ('Currency', '0x0348'),
+                      ('TrailingDigits', '0x{:02x}'.format(self.price_digits)), ('Tier', '0x01'),
+                      ('RateLabel', 'Set by User')]
+        elif tag == 'TimeCluster':
+            fields = [('MeterMacId', self.meter_mac), ('UTCTime', now), ('LocalTime', now)]
+        elif tag == 'MessageCluster':
+            fields = [('MeterMacId', self.meter_mac), ('TimeStamp', now), ('Id', '0x00000000'),
+                      ('Text', ''), ('ConfirmationRequired', 'N'), ('Confirmed', 'N'),
+                      ('Queue', 'Active')]
+        elif tag in ('ConnectionStatus', 'NetworkInfo'):
+            fields = [('MeterMacId' if tag == 'ConnectionStatus' else 'CoordMacId', self.meter_mac),
+                      ('Status', 'Connected'), ('Description', 'Successfully Joined'),
+                      ('ExtPanId', self.meter_mac), ('Channel', '20'), ('ShortAddr', '0xe1a5'),
+                      ('LinkStrength', '0x64')]
+        elif tag == 'DeviceInfo':
+            fields = [('InstallCode', '0x1234567890abcdef'), ('LinkKey', '0x0123456789abcdef'),
+                      ('FWVersion', '2.0.0 (7400)'), ('HWVersion', '2.7.3'), ('ImageType', '0x2201'),
+                      ('Manufacturer', 'Rainforest Automation, Inc.'), ('ModelId', 'Z105-2-EMU2-LEDD_JM'),
+                      ('DateCode', '2014080142280031')]
+        elif tag == 'MeterList':
+            fields = [('MeterMacId', self.meter_mac)]
+        elif tag == 'MeterInfo':
+            fields = [('MeterMacId', self.meter_mac), ('MeterType', '0x0000'), ('NickName', ''),
+                      ('Enabled', 'Y')]
+        else:
+            raise ValueError("Unsupported tag " + tag)
+
+        return self._fragment(tag, fields)
+
+    # Hourly interval data for the requested periods. The meter keeps
+    # profile_days of history; asking for anything older gets a status of
+    # 0x05, no intervals available.
+    def _profile_data(self, command):
+
+        count = int(command.findtext('NumberOfPeriods') or '0x01', 16)
+        end = command.findtext('EndTime')
+        end = time.time() if end is None else response_entities.rainforest_to_unix(end)
+        end -= end % 3600
+        oldest = time.time() - self.profile_days * 86400
+
+        intervals = []
+        for i in range(count):
+            interval_end = end - i * 3600
+            if interval_end <= oldest:
+                break
+            # Usage in Wh, varying by hour but the same on every request
+            usage = self.base_demand * 1000 * (1 + 0.5 * math.sin(interval_end / 3600.0))
+            intervals.append(('IntervalData', '0x{:06x}'.format(int(usage))))
+
+        return self._fragment('ProfileData', [
+            ('MeterMacId', self.meter_mac),
+            ('EndTime', self._device_time(end)),
+            ('Status', '0x00' if intervals else '0x05'),
+            ('ProfileIntervalPeriod', '0x01'),
+            ('NumberOfPeriodsDelivered', '0x{:02x}'.format(len(intervals)))
+        ] + intervals)
+
+    def _formatting(self):
+        return [('Multiplier', '0x00000001'), ('Divisor', '0x000003e8'), ('DigitsRight', '0x03'),
+                ('DigitsLeft', '0x0f'), ('SuppressLeadingZero', 'Y')]
+
+    # Serialize a fragment in the layout the device uses, one tag per line
+    def _fragment(self, tag, fields):
+        lines = ['<' + tag + '>', '  <DeviceMacId>' + self.device_mac + '</DeviceMacId>']
+        for name, value in fields:
+            lines.append('  <{0}>{1}</{0}>'.format(name, self._escape(value)))
+        lines.append('</' + tag + '>')
+        return ('\r\n'.join(lines) + '\r\n').encode('ASCII')
+
+    def _escape(self, value):
+        return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    def _device_time(self, unix_time=None):
+        if unix_time is None:
+            unix_time = time.time()
+        return '0x{:08x}'.format(int(unix_time) - response_entities.RAINFOREST_EPOCH)
+
+    # Advance the meter model to the current time
+    def _update_meter(self):
+        now = time.time()
+        elapsed = now - self._last_update
+        self._last_update = now
+
+        self.summation += self.demand * elapsed / 3600.0
+        self.demand = max(0.0, self.demand + self._random.gauss(0, 0.05) +
+                          0.01 * (self.base_demand - self.demand))
+
+    # Queue data to be written, applying jitter, corruption and fragmentation
+    def _send(self, data):
+
+        self.fragments_sent += 1
+        if self.corrupt_probability > 0 and self._random.random() < self.corrupt_probability:
+            self.fragments_corrupted += 1
+            data = bytearray(data)
+            data[self._random.randrange(len(data))] = self._random.choice(b'<>&/\x00')
+            data = bytes(data)
+
+        due = time.time()
+        if self.jitter > 0:
+            due += self._random.uniform(0, self.jitter)
+
+        # Keep ordering: never schedule before something already queued
+        if self._outbox:
+            due = max(due, max(item[0] for item in self._outbox))
+
+        pieces = [data]
+        if self.fragment_size > 0:
+            pieces = []
+            while data:
+                size = self._random.randint(1, self.fragment_size)
+                pieces.append(data[:size])
+                data = data[size:]
+
+        for piece in pieces:
+            self._sequence += 1
+            heapq.heappush(self._outbox, (due, self._sequence, piece))
+            due += self.fragment_delay
+
+    def _device_thread(self):
+
+        parser = StreamParser(root_tags=['Command'])
+        while not self._stop_thread:
+
+            now = time.time()
+            self._push_due_notifications(now)
+
+            while self._outbox and self._outbox[0][0] <= now:
+                _, _, piece = heapq.heappop(self._outbox)
+                os.write(self._master, piece)
+
+            # Sleep until the next thing is due, or a command arrives
+            wake = [now + 0.1]
+            if self._outbox:
+                wake.append(self._outbox[0][0])
+            with self._lock:
+                wake.extend(self._next_due.values())
+            timeout = max(0.0, min(wake) - now)
+
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if not readable:
+                continue
+
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+
+            for command in parser.feed(data):
+                response = self.respond(command)
+                if response is not None:
+                    self._send(response)
+
+    def _push_due_notifications(self, now):
+
+        with self._lock:
+            due = [tag for tag, at in self._next_due.items() if at <= now]
+            for tag in due:
+                interval = self._intervals.get(tag)
+                if tag == 'InstantaneousDemand' and now < self._fast_poll_until:
+                    interval = self._fast_poll_interval
+                if interval is None:
+                    del self._next_due[tag]
+                else:
+                    self._next_due[tag] = max(self._next_due[tag] + interval, now)
+
+        for tag in due:
+            self._update_meter()
+            self._send(self.notification(tag))
+
+
+# Command name to the tag of the response it produces
+_COMMAND_RESPONSES = {
+    'get_connection_status': 'ConnectionStatus',
+    'get_device_info': 'DeviceInfo',
+    'get_meter_list': 'MeterList',
+    'get_meter_info': 'MeterInfo',
+    'get_network_info': 'NetworkInfo',
+    'get_time': 'TimeCluster',
+    'get_message': 'MessageCluster',
+    'get_current_price': 'PriceCluster',
+    'get_instantaneous_demand': 'InstantaneousDemand',
+    'get_current_summation_delivered': 'CurrentSummationDelivered',
+    'get_current_period_usage': 'CurrentPeriodUsage',
+    'get_last_period_usage': 'LastPeriodUsage'
+}
@@ -0,0 +1,276 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from emu_power import response_entities
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def _unix(text):
+    return response_entities.rainforest_to_unix(text)
+
+
+def _price(entity):
+    if entity.price is None:
+        return None
+    return response_entities.scale_price(entity.price, entity.trailing_digits)
+
+
+def _hex_or_none(text):
+    return None if text is None else int(text, 16)
+
+
+# Interval values as comma separated text, oldest first
+def _intervals(entity):
+    return ','.join('{:g}'.format(value) for value in entity.interval_data)
+
+
+# The tables written for each entity class, as (table name, columns) keyed
+# by root tag. Each column is (name, SQL type, function extracting the value
+# from an entity). Every table also gets a received_at column holding the
+# Unix time the entity was queued.
+TABLES = {
+    'InstantaneousDemand': ('instantaneous_demand', (
+        ('device_mac', 'TEXT', lambda e: e.device_mac),
+        ('meter_mac', 'TEXT', lambda e: e.meter_mac),
+        ('timestamp', 'INTEGER', lambda e: _unix(e.timestamp)),
+        ('demand', 'REAL', lambda e: e.reading)
+    )),
+    'CurrentSummationDelivered': ('summation_delivered', (
+        ('device_mac', 'TEXT', lambda e: e.device_mac),
+        ('meter_mac', 'TEXT', lambda e: e.meter_mac),
+        ('timestamp', 'INTEGER', lambda e: _unix(e.timestamp)),
+        ('delivered', 'REAL', lambda e: e.reading),
+        ('received', 'REAL', lambda e: response_entities.scale_reading(
+            e.summation_received, e.multiplier, e.divisor))
+    )),
+    'PriceCluster': ('price', (
+        ('device_mac', 'TEXT', lambda e: e.device_mac),
+        ('meter_mac', 'TEXT', lambda e: e.meter_mac),
+        ('timestamp', 'INTEGER', lambda e: _unix(e.timestamp)),
+        ('price', 'REAL', _price),
+        ('currency', 'INTEGER', lambda e: _hex_or_none(e.currency)),
+        ('tier', 'INTEGER', lambda e: _hex_or_none(e.tier))
+    )),
+    'ProfileData': ('profile_data', (
+        ('device_mac', 'TEXT', lambda e: e.device_mac),
+        ('meter_mac', 'TEXT', lambda e: e.meter_mac),
+        ('end_time', 'INTEGER', lambda e: _unix(e.end_time)),
+        ('status', 'TEXT', lambda e: e.status),
+        ('period_interval', 'TEXT', lambda e: e.period_interval),
+        ('number_of_periods', 'TEXT', lambda e: e.number_of_periods),
+        ('interval_seconds', 'INTEGER', lambda e: e.interval_seconds),
+        ('interval_data', 'TEXT', _intervals)
+    ))
+}
+
+
+# Name and SQL type of every column of the table for a tag, as written by
+# SinkWriter and emu_power.offline
+def table_columns(tag):
+    return [(name, sql_type) for name, sql_type, _ in TABLES[tag][1]] + [('received_at', 'REAL')]
+
+
+# Base class for a destination of rows. All methods are called from the
+# SinkWriter thread only.
+class Sink:
+
+    # Called once before the first write
+    def open(self):
+        return
+
+    # Write a batch of rows to a table. Columns is the list of
+    # (name, SQL type) pairs the row tuples follow.
+    def write(self, table, columns, rows):
+        raise NotImplementedError
+
+    # Called once after the last write
+    def close(self):
+        return
+
+
+# Writes rows into an SQLite database, one transaction per batch
+class SQLiteSink(Sink):
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._created = set()
+
+    def open(self):
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+
+    def write(self, table, columns, rows):
+
+        if table not in self._created:
+            definition = ', '.join(name + ' ' + sql_type for name, sql_type in columns)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, definition))
+            self._created.add(table)
+
+        statement = 'INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * len(columns)))
+        with self._connection:
+            self._connection.executemany(statement, rows)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+# Writes rows into one Parquet file per table in a directory, each batch
+# becoming a row group. Requires the pyarrow package.
+class ParquetSink(Sink):
+
+    _TYPES = {'TEXT': 'string', 'INTEGER': 'int64', 'REAL': 'float64'}
+
+    def __init__(self, directory):
+        if pyarrow is None:
+            raise ImportError("ParquetSink requires the pyarrow package")
+        self.directory = directory
+        self._writers = {}
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, table, columns, rows):
+
+        writer = self._writers.get(table)
+        if writer is None:
+            schema = pyarrow.schema([(name, self._TYPES[sql_type]) for name, sql_type in columns])
+            path = os.path.join(self.directory, '{}-{}.parquet'.format(table, int(time.time())))
+            writer = pyarrow.parquet.ParquetWriter(path, schema)
+            self._writers[table] = writer
+
+        data = {name: [row[i] for row in rows] for i, (name, _) in enumerate(columns)}
+        writer.write_table(pyarrow.Table.from_pydict(data, schema=writer.schema))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+# Collects entities from the reader and writes them to one or more sinks in
+# bulk from a background thread. Entities are turned into rows and placed
+# on a bounded queue without ever blocking, so a stalled disk cannot hold up
+# serial reads; if the queue is full, the entity is dropped and counted in
+# dropped. Rows are flushed once batch_size have built up, or after
+# flush_interval seconds, whichever comes first. A sink that fails to write
+# a batch loses that batch, counted in errors, but the writer carries on.
+# A sink that fails to open is counted in errors and left out. Rows stored
+# by at least one sink are counted in written.
+class SinkWriter:
+
+    def __init__(self, sinks, batch_size=500, flush_interval=1.0, max_queue=100000):
+
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+
+        self._queue = queue.Queue(max_queue)
+        self._thread_handle = None
+
+    # Subscribe to the entities with tables from an Emu object
+    def attach(self, emu):
+        return [emu.subscribe(response_entities.Entity.tag_to_class(tag), self.put) for tag in TABLES]
+
+    # Queue an entity to be written. Entities without a table are ignored.
+    def put(self, entity):
+
+        table = TABLES.get(entity.tag_name())
+        if table is None:
+            return
+
+        try:
+            row = tuple(extract(entity) for _, _, extract in table[1]) + (time.time(),)
+        except (ValueError, TypeError):
+            self.dropped += 1
+            return
+
+        try:
+            self._queue.put_nowait((entity.tag_name(), row))
+        except queue.Full:
+            self.dropped += 1
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+
+        if self._thread_handle is not None:
+            return
+
+        self._thread_handle = threading.Thread(target=self._writer_thread, daemon=True)
+        self._thread_handle.start()
+
+    # Write out everything queued so far, then stop
+    def stop(self):
+
+        if self._thread_handle is None:
+            return
+
+        self._queue.put((None, None))
+        self._thread_handle.join()
+        self._thread_handle = None
+
+    def _writer_thread(self):
+
+        sinks = []
+        for sink in self.sinks:
+            try:
+                sink.open()
+                sinks.append(sink)
+            except Exception:
+                self.errors += 1
+
+        batch = {}
+        batch_rows = 0
+        deadline = time.time() + self.flush_interval
+        stopping = False
+
+        while not stopping:
+            try:
+                tag, row = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                if tag is None:
+                    stopping = True
+                else:
+                    batch.setdefault(tag, []).append(row)
+                    batch_rows += 1
+            except queue.Empty:
+                pass
+
+            if stopping or batch_rows >= self.batch_size or time.time() >= deadline:
+                self._flush(sinks, batch)
+                batch = {}
+                batch_rows = 0
+                deadline = time.time() + self.flush_interval
+
+        for sink in sinks:
+            try:
+                sink.close()
+            except Exception:
+                self.errors += 1
+
+    def _flush(self, sinks, batch):
+        for tag, rows in batch.items():
+            table = TABLES[tag][0]
+            columns = table_columns(tag)
+            stored = False
+            for sink in sinks:
+                try:
+                    sink.write(table, columns, rows)
+                    stored = True
+                except Exception:
+                    self.errors += 1
+            if stored:
+                self.written += len(rows)
@@ -0,0 +1,92 @@
+import queue
+import threading
+
+# Policies for a queued subscription whose queue is full. DROP_OLDEST makes
+# room by discarding the oldest queued entity, DROP_NEWEST discards the entity
+# that just arrived, and BLOCK makes the reader wait for the subscriber to
+# catch up, which also holds up reading from the serial port.
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+# A callback registered to receive entities as they are parsed. With a queue
+# size of 0 the callback runs directly on the reader thread and should return
+# quickly. Otherwise entities are handed to a bounded queue drained by a
+# worker thread, so a slow callback cannot stall serial reads; what happens
+# when the queue fills up is decided by the policy. The number of entities
+# dropped is kept in the dropped attribute.
+class Subscription:
+
+    def __init__(self, callback, tag=None, queue_size=0, policy=DROP_OLDEST, debug=False):
+
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError('Invalid queue policy specified')
+
+        self.callback = callback
+        self.tag = tag
+        self.policy = policy
+        self.debug = debug
+        self.dropped = 0
+
+        self._queue = None
+        self._thread_handle = None
+        if queue_size > 0:
+            self._queue = queue.Queue(queue_size)
+            self._thread_handle = threading.Thread(target=self._worker_thread, daemon=True)
+            self._thread_handle.start()
+
+    # Called by the reader for each matching entity
+    def deliver(self, entity):
+
+        if self._queue is None:
+            self._call(entity)
+            return
+
+        if self.policy == BLOCK:
+            self._queue.put(entity)
+            return
+
+        try:
+            self._queue.put_nowait(entity)
+            return
+        except queue.Full:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+
+        # Make room by discarding the oldest entity. The worker may have
+        # emptied the queue in the meantime, which is fine.
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(entity)
+        except queue.Full:
+            pass
+
+    # Number of entities waiting to be handled
+    def pending(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    # Stop the worker thread once it has handled everything queued so far
+    def close(self):
+        if self._thread_handle is not None:
+            self._queue.put(None)
+            self._thread_handle = None
+
+    def _worker_thread(self):
+        while True:
+            entity = self._queue.get()
+            if entity is None:
+                return
+            self._call(entity)
+
+    # A broken callback must not take the reader down with it
+    def _call(self, entity):
+        try:
+            self.callback(entity)
+        except Exception as e:
+            if self.debug:
+                print("Subscriber raised " + repr(e))
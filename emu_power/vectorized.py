@@ -0,0 +1,134 @@
+from xml.etree import ElementTree
+from emu_power import response_entities
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Batch conversion of metering readings into NumPy arrays. Rather than
+# building an entity per reading and doing the scaling math one object at
+# a time, the raw hex strings are gathered from every fragment and then
+# decoded, scaled and converted from the Rainforest epoch in a handful of
+# array operations. Requires the numpy package.
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("Vectorized conversion requires the numpy package")
+
+
+# Value of each ASCII character as a hex digit, or -1 if it is not one
+_NIBBLES = None
+
+
+def _nibbles():
+    global _NIBBLES
+    if _NIBBLES is None:
+        table = numpy.full(256, -1, dtype=numpy.int64)
+        for i, c in enumerate(b'0123456789abcdef'):
+            table[c] = i
+        for i, c in enumerate(b'ABCDEF'):
+            table[c] = 10 + i
+        _NIBBLES = table
+    return _NIBBLES
+
+
+# Decode a list of hex strings (with or without a 0x prefix) into an array
+# of uint64, so that 64 bit counters such as SummationDelivered keep their
+# full range. Missing values decode as 0. As when building entities, values
+# that are not hex or are too large for 64 bits raise ValueError. Works on
+# every string at once, a column of characters at a time.
+def hex_array(values):
+
+    _require_numpy()
+
+    values = list(values)
+    digit_strings = [v[2:] if v and v[:2] in ('0x', '0X') else (v or '0') for v in values]
+    try:
+        encoded = numpy.array(digit_strings, dtype='S')
+    except UnicodeEncodeError:
+        raise ValueError("Hex values must be ASCII")
+    if len(encoded) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    chars = encoded.view(numpy.uint8).reshape(len(encoded), encoded.itemsize)
+    digits = _nibbles()[chars]
+
+    # Shorter strings are padded with nulls at the end, which are skipped.
+    # Any other character that is not a hex digit is an error, as is a
+    # prefix with no digits after it.
+    padding = numpy.maximum.accumulate(chars == 0, axis=1)
+    invalid = ((digits < 0) != padding).any(axis=1) | (digits[:, 0] < 0)
+    if invalid.any():
+        raise ValueError("Invalid hex value " + repr(values[int(numpy.argmax(invalid))]))
+
+    result = numpy.zeros(len(encoded), dtype=numpy.uint64)
+    for column in digits.T:
+        valid = column >= 0
+        if numpy.any(valid & (result >> numpy.uint64(60) != 0)):
+            raise ValueError("Hex value does not fit in 64 bits")
+        shifted = result * numpy.uint64(16) + numpy.where(valid, column, 0).astype(numpy.uint64)
+        result = numpy.where(valid, shifted, result)
+    return result
+
+
+# Convert hex Rainforest timestamps into Unix times. Missing timestamps
+# become NaN.
+def timestamp_array(values):
+    _require_numpy()
+    result = hex_array(values).astype(numpy.float64) + response_entities.RAINFOREST_EPOCH
+    result[numpy.array([v is None for v in values], dtype=bool)] = numpy.nan
+    return result
+
+
+# Array equivalent of response_entities.scale_reading
+def scale_readings(values, multipliers, divisors):
+    _require_numpy()
+    numerator = numpy.asarray(values, dtype=numpy.float64) * multipliers
+    divisors = numpy.asarray(divisors, dtype=numpy.float64)
+    return numpy.divide(numerator, divisors, out=numpy.zeros_like(numerator), where=divisors != 0)
+
+
+# Convert raw fragments of a metering class (InstantaneousDemand,
+# CurrentSummationDelivered or CurrentPeriodUsage) into arrays of Unix
+# timestamps and scaled readings. Fragments may be ElementTree elements,
+# as produced by StreamParser, or XML strings. Fragments of any other type
+# are skipped.
+def fragments_to_arrays(fragments, klass):
+
+    _require_numpy()
+
+    tag = klass.tag_name()
+    value_tag = klass.reading_tag
+    timestamps, values, multipliers, divisors = [], [], [], []
+
+    for tree in fragments:
+        if not isinstance(tree, ElementTree.Element):
+            tree = ElementTree.fromstring(tree)
+        if tree.tag != tag:
+            continue
+
+        texts = {child.tag: child.text for child in tree}
+        timestamps.append(texts.get('TimeStamp'))
+        values.append(texts.get(value_tag))
+        multipliers.append(texts.get('Multiplier'))
+        divisors.append(texts.get('Divisor'))
+
+    readings = scale_readings(hex_array(values), hex_array(multipliers), hex_array(divisors))
+    return timestamp_array(timestamps), readings
+
+
+# Convert a list of (timestamp, reading) pairs, as returned by
+# Emu.get_history, into two arrays
+def entries_to_arrays(entries):
+    _require_numpy()
+    pairs = numpy.array(entries, dtype=numpy.float64).reshape(-1, 2)
+    return pairs[:, 0].copy(), pairs[:, 1].copy()
+
+
+# Get the contents of a History as two arrays, oldest first
+def history_to_arrays(history):
+    _require_numpy()
+    timestamps, readings = history.arrays()
+    return numpy.frombuffer(timestamps, dtype=numpy.float64), numpy.frombuffer(readings, dtype=numpy.float64)
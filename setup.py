@@ -16,6 +16,17 @@ setuptools.setup(
     install_requires=[
         'pyserial'
     ],
+    extras_require={
+        'async': ['pyserial-asyncio'],
+        'numpy': ['numpy'],
+        'parquet': ['pyarrow']
+    },
+    entry_points={
+        'console_scripts': [
+            'emu-decode = emu_power.offline:main',
+            'emu-gateway = emu_power.gateway:main'
+        ]
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
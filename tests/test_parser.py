@@ -0,0 +1,122 @@
+import random
+import unittest
+from emu_power.parser import StreamParser
+from emu_power.simulator import EmuSimulator
+
+TAGS = ['InstantaneousDemand', 'CurrentSummationDelivered', 'PriceCluster', 'TimeCluster']
+
+
+# Regression tests for resynchronizing on split, corrupt and truncated
+# streams, using fragments in the layout the simulator sends
+class StreamParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = EmuSimulator(seed=1)
+
+    def fragments(self, tags):
+        return [self.simulator.notification(tag) for tag in tags]
+
+    # Feed data in pieces, returning the tags of the fragments parsed
+    def feed(self, parser, data, sizes):
+        tags = []
+        start = 0
+        for size in sizes:
+            tags += [tree.tag for tree in parser.feed(data[start:start + size])]
+            start += size
+        tags += [tree.tag for tree in parser.feed(data[start:])]
+        return tags
+
+    def test_whole_stream(self):
+        parser = StreamParser()
+        self.assertEqual([tree.tag for tree in parser.feed(b''.join(self.fragments(TAGS)))], TAGS)
+        self.assertEqual(parser.bytes_discarded, 0)
+        self.assertEqual(parser.fragments_discarded, 0)
+
+    def test_split_feeds(self):
+        data = b''.join(self.fragments(TAGS * 3))
+        rand = random.Random(2)
+        for chunk in (1, 3, 17, 64):
+            parser = StreamParser()
+            self.assertEqual(self.feed(parser, data, [chunk] * (len(data) // chunk)), TAGS * 3)
+            self.assertEqual(parser.fragments_discarded, 0)
+
+        parser = StreamParser()
+        sizes = [rand.randint(1, 40) for _ in range(len(data) // 20)]
+        self.assertEqual(self.feed(parser, data, sizes), TAGS * 3)
+        self.assertEqual(parser.fragments_discarded, 0)
+
+    def test_no_newline_between_fragments(self):
+        parser = StreamParser()
+        data = b''.join(f.rstrip() for f in self.fragments(TAGS))
+        self.assertEqual(self.feed(parser, data, [5] * (len(data) // 5)), TAGS)
+        self.assertEqual(len(parser._pending), 0)
+
+    def test_corrupt_byte(self):
+        first, middle, last = self.fragments(TAGS[:3])
+        middle = bytearray(middle)
+        middle[middle.index(b'<SummationDelivered>') + 3] = ord('<')
+
+        for sizes in ([], [1] * (len(first) + len(middle) + len(last))):
+            parser = StreamParser()
+            tags = self.feed(parser, first + bytes(middle) + last, sizes)
+            self.assertEqual(tags, [TAGS[0], TAGS[2]])
+            self.assertEqual(parser.fragments_discarded, 1)
+            self.assertGreater(parser.bytes_discarded, 0)
+
+    def test_unknown_root_tag(self):
+        first, middle, last = self.fragments(TAGS[:3])
+        middle = middle.replace(b'<CurrentSummationDelivered>', b'<CurrentSummatXonDelivered>')
+
+        parser = StreamParser()
+        tags = self.feed(parser, first + middle + last, [])
+        self.assertEqual(tags, [TAGS[0], TAGS[2]])
+        self.assertEqual(parser.fragments_discarded, 1)
+
+    def test_nested_root(self):
+        first, middle, last = self.fragments(TAGS[:3])
+        truncated = middle[:middle.index(b'<Multiplier>')]
+
+        for sizes in ([], [7] * ((len(first) + len(truncated) + len(last)) // 7)):
+            parser = StreamParser()
+            tags = self.feed(parser, first + truncated + last, sizes)
+            self.assertEqual(tags, [TAGS[0], TAGS[2]])
+            self.assertEqual(parser.fragments_discarded, 1)
+
+    def test_oversized_fragment(self):
+        parser = StreamParser(max_fragment_size=1024)
+        parser.feed(b'<InstantaneousDemand>\n')
+        for _ in range(1000):
+            parser.feed(b'  <Demand>0x000001</Demand>\n')
+        self.assertLessEqual(len(parser._pending), 1024)
+        self.assertEqual(parser.fragments_discarded, 1)
+
+        self.assertEqual(self.feed(parser, b''.join(self.fragments(TAGS)), []), TAGS)
+        self.assertEqual(parser.fragments_discarded, 1)
+
+    def test_random_corruption(self):
+        rand = random.Random(3)
+        fragments = self.fragments(TAGS * 50)
+        sent = []
+        data = bytearray()
+        for fragment in fragments:
+            if rand.random() < 0.2:
+                fragment = bytearray(fragment)
+                fragment[rand.randrange(len(fragment))] = rand.choice(b'<>&/\x00')
+            data += fragment
+            sent.append(fragment)
+
+        parser = StreamParser()
+        sizes = [rand.randint(1, 50) for _ in range(len(data) // 25)]
+        tags = self.feed(parser, bytes(data), sizes)
+
+        # Nothing is returned twice or made up, and intact fragments get
+        # through
+        self.assertLessEqual(len(tags), len(fragments))
+        expected = iter(TAGS * 50)
+        for tag in tags:
+            self.assertIn(tag, expected)
+        self.assertGreater(len(tags), len(fragments) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()